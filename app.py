@@ -5,6 +5,7 @@ import math
 from collections import defaultdict
 from typing import Optional
 
+import PIL
 import peewee
 import timeago
 from PIL import Image
@@ -13,10 +14,13 @@ from flask import Flask, render_template, send_file, request, url_for, make_resp
 from peewee import fn
 
 from scripts.entry import entry_key_readable_source, ALL_SOURCE_TYPES
+from scripts.image_hashing import HASH_BITS
+from scripts.image_search import image_search_index, search_image
 from scripts.index import *
 
 app = Flask(__name__, static_folder="static", static_url_path="")
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 60 * 60
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
 
 SITEMAP_URL_LIMIT = 5000
 
@@ -496,6 +500,42 @@ def route_book(key: str):
     )
 
 
+@app.route("/image-search", methods=["GET", "POST"])
+def route_image_search():
+    if request.method == "GET":
+        return render_template("image_search.html", books=[], searched=False)
+
+    # Only errors in reading the upload are answered as the user's.
+    try:
+        image_search_index()
+    except FileNotFoundError:
+        return render_template(
+            "error.html",
+            message="Image search is being updated. Please check back later.",
+        ), 503
+
+    upload = request.files.get("image")
+    try:
+        results = search_image(upload.read()) if upload else None
+    except Image.DecompressionBombError:
+        return render_template(
+            "error.html",
+            message="The image is too large.",
+        ), 400
+    except (PIL.UnidentifiedImageError, OSError):
+        results = None
+    if results is None:
+        return render_template(
+            "error.html",
+            message="The image could not be read.",
+        ), 400
+
+    book_data = build_books([result.book_id for result in results], EntriesFilter())
+    books = [(round((1.0 - result.distance / HASH_BITS) * 100), book_data[result.book_id])
+             for result in results if result.book_id in book_data]
+    return render_template("image_search.html", books=books, searched=True)
+
+
 @app.route("/thumbnail/<key>.jpg")
 def route_thumbnail(key: str):
     data = IndexThumbnail.get_by_id(key).data
@@ -542,6 +582,7 @@ def route_sitemap_static():
     return as_xml(render_template("sitemap.xml", paths=[
         url_for("route_index"),
         url_for("route_popular"),
+        url_for("route_image_search"),
         url_for("route_recipes"),
         url_for("route_about"),
     ]))
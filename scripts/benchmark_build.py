@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+from .build_report import stage, database_row_count
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_hashing() -> int:
+    from . import build_image_hashes
+    build_image_hashes.main()
+    return database_row_count(build_image_hashes.db)
+
+
+def run_grouping() -> int:
+    from . import build_index
+    lists = build_index.form_book_groups()
+    return sum(len(entry_list.entries) for entry_list in lists)
+
+
+def run_index() -> int:
+    from . import build_index
+    build_index.main()
+    return database_row_count(build_index.db)
+
+
+BENCHMARKS = {
+    "hashing": run_hashing,
+    "grouping": run_grouping,
+    "index": run_index,
+}
+
+
+def run_benchmark(name: str):
+    with stage(f"benchmark/{name}") as record:
+        record.rows = BENCHMARKS[name]()
+
+    print(f"[benchmark/{name}] "
+          f"{record.rows} rows in {record.wall_seconds:.1f}s "
+          f"({record.rows / record.wall_seconds:,.0f} rows/s), "
+          f"{record.cpu_seconds:.1f}s cpu, "
+          f"{record.process_peak_rss_mb:.0f} MiB process peak rss")
+
+
+# Usage: python -m scripts.benchmark_build <directory> [benchmark]
+# The directory must contain a corpus from `scripts.synthetic_corpus`.
+# Each benchmark runs in its own process so that peak memory is measured separately.
+def main():
+    directory = os.path.abspath(sys.argv[1])
+    os.chdir(directory)
+
+    if len(sys.argv) > 2:
+        run_benchmark(sys.argv[2])
+        return
+
+    environment = {**os.environ, "PYTHONPATH": REPOSITORY_PATH}
+    for name in BENCHMARKS.keys():
+        subprocess.run(
+            [sys.executable, "-u", "-m", "scripts.benchmark_build", directory, name],
+            env=environment,
+            check=True,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from peewee import SqliteDatabase
+
+from .bulk_writer import BulkWriter
+from .index import IndexBook, IndexBookTitle, IndexEntry, IndexLanguage
+
+BOOK_COUNT = 100000
+TITLES_PER_BOOK = 3
+ENTRIES_PER_BOOK = 2
+MODELS = [IndexBook, IndexBookTitle, IndexEntry, IndexLanguage]
+
+
+def synthetic_rows():
+    rng = random.Random(0)
+    languages = ["Japanese", "English", "Chinese", "Spanish"]
+    epoch = datetime.datetime(2005, 1, 1, tzinfo=datetime.timezone.utc)
+
+    books = [(book, f"Book {book}", None, f"eh-{book}") for book in range(BOOK_COUNT)]
+    titles = [(book, f"Title {book} {index}")
+              for book in range(BOOK_COUNT)
+              for index in range(TITLES_PER_BOOK)]
+    entries = [(
+        f"eh-{book}-{index}",
+        book,
+        f"Entry {book} {index}",
+        f"https://example.com/{book}/{index}",
+        epoch + datetime.timedelta(days=rng.randrange(7000)),
+        rng.choice(languages),
+        rng.randrange(1, 200),
+        rng.randrange(100),
+    ) for book in range(BOOK_COUNT) for index in range(ENTRIES_PER_BOOK)]
+    return books, titles, entries
+
+
+def write_with_bulk_create(path: str, books, titles, entries):
+    database = SqliteDatabase(path, pragmas={"journal_mode": "wal"})
+    with database.bind_ctx(MODELS):
+        database.connect()
+        with database.atomic():
+            database.create_tables(MODELS)
+            IndexBook.bulk_create([
+                IndexBook(id=book, main_title=title, series=series, thumbnail=thumbnail)
+                for book, title, series, thumbnail in books
+            ], 10000)
+            IndexBookTitle.bulk_create([
+                IndexBookTitle(book=book, title=title)
+                for book, title in titles
+            ], 10000)
+            IndexEntry.bulk_create([
+                IndexEntry(id=key, book=book, title=title, url=url, date=date,
+                           language=language, page_count=page_count, comments=comments)
+                for key, book, title, url, date, language, page_count, comments in entries
+            ], 10000)
+        database.close()
+
+
+def write_with_bulk_writer(path: str, books, titles, entries):
+    database = SqliteDatabase(path, pragmas={"journal_mode": "wal"})
+    with database.bind_ctx(MODELS):
+        writer = BulkWriter(database)
+        database.connect()
+        writer.use_build_pragmas()
+        with database.atomic():
+            writer.create_tables(MODELS)
+            writer.write(IndexBook, [
+                IndexBook.id,
+                IndexBook.main_title,
+                IndexBook.series,
+                IndexBook.thumbnail,
+            ], iter(books))
+            writer.write(IndexBookTitle, [IndexBookTitle.book, IndexBookTitle.title], iter(titles))
+            writer.write(IndexEntry, [
+                IndexEntry.id,
+                IndexEntry.book,
+                IndexEntry.title,
+                IndexEntry.url,
+                IndexEntry.date,
+                IndexEntry.language,
+                IndexEntry.page_count,
+                IndexEntry.comments,
+            ], iter(entries))
+            writer.create_indexes(MODELS)
+        writer.finish()
+        database.close()
+
+
+def main():
+    books, titles, entries = synthetic_rows()
+    row_count = len(books) + len(titles) + len(entries)
+    print(f"[benchmark/rows] {row_count}")
+
+    for name, write in [
+        ("bulk_create", write_with_bulk_create),
+        ("bulk_writer", write_with_bulk_writer),
+    ]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "index.db")
+            start = time.perf_counter()
+            write(path, books, titles, entries)
+            elapsed = time.perf_counter() - start
+            print(f"[benchmark/{name}] {elapsed:.2f}s ({row_count / elapsed:,.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import random
+import time
+
+import numpy
+
+from . import hamming_numpy
+
+HASH_COUNT = 750000
+QUERY_COUNT = 50
+THRESHOLD = 12
+
+
+def benchmark(name: str, module, h8s: list[int], queries: list[int]):
+    hash_list = module.HammingHashList()
+    start = time.perf_counter()
+    for h8 in h8s:
+        hash_list.add(h8)
+    elapsed = time.perf_counter() - start
+    print(f"[benchmark/{name}/add] {elapsed:.2f}s ({len(h8s) / elapsed:,.0f} hashes/s)")
+
+    hash_view = module.HammingHashView(numpy.array(h8s, dtype=numpy.uint64))
+    for method, search in [
+        ("find_closest", lambda h8: hash_list.find_closest(h8, THRESHOLD)),
+        ("find_within", lambda h8: hash_list.find_within(h8, THRESHOLD)),
+        ("view_find_within", lambda h8: hash_view.find_within(h8, THRESHOLD)),
+    ]:
+        start = time.perf_counter()
+        for h8 in queries:
+            search(h8)
+        elapsed = (time.perf_counter() - start) / len(queries)
+        print(f"[benchmark/{name}/{method}] {elapsed * 1000:.2f}ms per query "
+              f"({len(h8s) / elapsed / 1e9:.2f}G hashes/s)")
+
+
+# Compares the compiled extension with the NumPy fallback over the same hashes.
+def main():
+    rng = random.Random(0)
+    h8s = [rng.getrandbits(64) for _ in range(HASH_COUNT)]
+    queries = [rng.getrandbits(64) for _ in range(QUERY_COUNT)]
+
+    try:
+        from . import hamming
+        benchmark("extension", hamming, h8s, queries)
+    except ImportError:
+        print("[benchmark/extension] not compiled, run `python -m scripts.compile_hamming`")
+    benchmark("numpy", hamming_numpy, h8s, queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from .build_report import stage, database_row_count
+from .http_client import http_metrics
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRAPERS = [
+    "source_eh",
+    "source_db",
+    "source_ds",
+    "source_md",
+    "source_mb",
+    "source_tora",
+]
+
+
+# Runs in a copy of the databases, with responses replayed from the cassette.
+def run_benchmark(name: str):
+    module = importlib.import_module(f"scripts.{name}")
+    rows_before = database_row_count(module.db)
+    module.db.close()
+
+    with stage(f"benchmark/{name}") as record:
+        module.main()
+        record.rows = database_row_count(module.db) - rows_before
+    pages = sum(host["requests"] for host in http_metrics().values())
+
+    print(f"[benchmark/{name}] "
+          f"{pages} pages, {record.rows} rows in {record.wall_seconds:.1f}s "
+          f"({pages / record.wall_seconds:,.1f} pages/s, {record.rows / record.wall_seconds:,.0f} rows/s), "
+          f"{record.cpu_seconds:.1f}s cpu, "
+          f"{record.process_peak_rss_mb:.0f} MiB process peak rss")
+
+
+# Usage: python -m scripts.benchmark_scrapers <cassette> <directory> [scraper...]
+# The cassette must be recorded with `HTTP_MODE=record` by scrapers that started
+# from the databases in `<directory>/data`, if any, which are copied and left untouched.
+# Set `HTTP_REPLAY_LATENCY` to simulate the network.
+def main():
+    cassette = os.path.abspath(sys.argv[1])
+    directory = os.path.abspath(sys.argv[2])
+    names = sys.argv[3:] or SCRAPERS
+
+    environment = {
+        **os.environ,
+        "PYTHONPATH": REPOSITORY_PATH,
+        "HTTP_MODE": "replay",
+        "HTTP_CASSETTE": cassette,
+        # Replayed requests are recorded without the key.
+        "SCRAPINGANT_API_KEY": os.environ.get("SCRAPINGANT_API_KEY") or "replay",
+    }
+    for name in names:
+        with tempfile.TemporaryDirectory() as working_directory:
+            data_path = os.path.join(working_directory, "data")
+            if os.path.isdir(os.path.join(directory, "data")):
+                shutil.copytree(os.path.join(directory, "data"), data_path)
+            else:
+                os.makedirs(data_path)
+            subprocess.run(
+                [sys.executable, "-u", "-c", f"from scripts.benchmark_scrapers import run_benchmark; "
+                                             f"run_benchmark({name!r})"],
+                cwd=working_directory,
+                env=environment,
+                check=True,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,113 +1,281 @@
-import io
+import collections
+import dataclasses
+import functools
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional
 
 import PIL
-import imagehash
-from peewee import SqliteDatabase, Model, CharField
-from PIL import Image, ImageChops
-from tqdm.contrib.concurrent import thread_map
+import numpy
+from peewee import SqliteDatabase, Model, CharField, BlobField, chunked
+from tqdm import tqdm
 
 from scripts.data_comic_thproject_net import CTHEntry
 from scripts.data_doujinshi_org import OrgEntry
 from scripts.source_ds import DSEntry
 from scripts.source_mb import mb_entries
 from scripts.source_tora import tora_entries
+from .build_report import stage
 from .entry import entry_key, Entry, entry_thumbnails
+from .image_hashing import HASH_SIZE, FINE_HASH_SIZE, FINE_HASH_BYTES, HASH_VERSION, candidate_images, \
+    image_hashes
 from .source_db import DBEntry
 from .source_eh import EHEntry
 from .source_md import all_md_chapters
 
 db = SqliteDatabase("data/phash.db")
 
+# Decoding and hashing hold the GIL, so thumbnails are hashed in worker processes.
+# Set `HASH_WORKERS=1` to hash in the main process instead.
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS") or os.cpu_count() or 1)
+HASH_WINDOW = HASH_WORKERS * 64
+HASH_BATCH_SIZE = 1000
+
+DIGEST_SIZE = 16
+
+
+# Hashes are packed little-endian 64-bit integers ordered in match priority.
+# Fine hashes are the 16x16 hashes of the same images, packed as 32 bytes each.
+# They are keyed by a digest of the thumbnails they were computed from,
+# so that entries with identical thumbnails share one row.
+# Thumbnails that cannot be decoded are stored without hashes.
+class ThumbnailHash(Model):
+    digest = CharField(primary_key=True)
+    hashes = BlobField()
+    fine_hashes = BlobField()
+
+    class Meta:
+        database = db
+        without_rowid = True
+
 
-# Hashes are space-separated and ordered in match priority.
 class ImageHash(Model):
     id = CharField(primary_key=True)
-    h8s = CharField()
+    digest = CharField(index=True)
 
     class Meta:
         database = db
+        without_rowid = True
+
+
+# Hashes of every entry, loaded without parsing each hash.
+# Keys are sorted, and hashes for key `i` are `hashes[starts[rows[i]]:starts[rows[i] + 1]]`.
+# Each row of `fine_hashes` belongs to the hash at the same position.
+@dataclasses.dataclass()
+class HashTable:
+    keys: numpy.ndarray
+    rows: numpy.ndarray
+    starts: numpy.ndarray
+    hashes: numpy.ndarray
+    fine_hashes: numpy.ndarray
+
+    def _positions(self, key: str) -> slice:
+        index = numpy.searchsorted(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return slice(0, 0)
+        row = self.rows[index]
+        return slice(self.starts[row], self.starts[row + 1])
+
+    def get(self, key: str) -> numpy.ndarray:
+        return self.hashes[self._positions(key)]
+
+    def get_fine(self, key: str) -> numpy.ndarray:
+        return self.fine_hashes[self._positions(key)]
+
+
+def pack_hashes(h8s: list[str]) -> bytes:
+    return numpy.array([int(h8, 16) for h8 in h8s], dtype="<u8").tobytes()
+
+
+def pack_fine_hashes(h16s: list[str]) -> bytes:
+    return b"".join(bytes.fromhex(h16) for h16 in h16s)
+
+
+# Aggregates each table in SQLite and joins them in NumPy,
+# so that Python never iterates over rows.
+# Aggregates in one query read the same rows in the same order, but SQLite does not
+# promise that it is the order of the subquery, so keys and digests are sorted if needed.
+@functools.cache
+def load_hash_table() -> HashTable:
+    query = ("SELECT group_concat(digest, ''), group_concat(length(hashes)), "
+             "group_concat(hex(hashes), ''), group_concat(hex(fine_hashes), '') "
+             "FROM (SELECT digest, hashes, fine_hashes FROM thumbnailhash ORDER BY digest)")
+    digests, lengths, hashes, fine_hashes = db.execute_sql(query).fetchone()
+    query = ("SELECT group_concat(id, char(10)), group_concat(digest, '') "
+             "FROM (SELECT id, digest FROM imagehash ORDER BY id)")
+    keys, key_digests = db.execute_sql(query).fetchone()
+    if digests is None or keys is None:
+        return HashTable(numpy.array([], dtype=str),
+                         numpy.zeros(0, dtype=numpy.int64),
+                         numpy.zeros(1, dtype=numpy.int64),
+                         numpy.zeros(0, dtype="<u8"),
+                         numpy.zeros((0, FINE_HASH_BYTES), dtype=numpy.uint8))
+
+    # Digests are fixed-width hexadecimal strings.
+    digest_type = f"S{DIGEST_SIZE * 2}"
+    digests = numpy.frombuffer(digests.encode(), dtype=digest_type)
+    key_digests = numpy.frombuffer(key_digests.encode(), dtype=digest_type)
+
+    keys = numpy.array(keys.split("\n"))
+    if not numpy.all(keys[:-1] < keys[1:]):
+        order = numpy.argsort(keys, kind="stable")
+        keys, key_digests = keys[order], key_digests[order]
+
+    # Rows keep their aggregated order, as hashes are stored in it.
+    if numpy.all(digests[:-1] < digests[1:]):
+        rows = numpy.searchsorted(digests, key_digests)
+    else:
+        order = numpy.argsort(digests, kind="stable")
+        rows = order[numpy.searchsorted(digests[order], key_digests)]
+
+    starts = numpy.zeros(len(digests) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.fromstring(lengths, dtype=numpy.int64, sep=",") // 8, out=starts[1:])
+    return HashTable(
+        keys=keys,
+        rows=rows,
+        starts=starts,
+        hashes=numpy.frombuffer(bytes.fromhex(hashes), dtype="<u8"),
+        fine_hashes=numpy.frombuffer(bytes.fromhex(fine_hashes), dtype=numpy.uint8)
+        .reshape(-1, FINE_HASH_BYTES),
+    )
 
 
 # Optimized for repeated calls.
 def entry_h8s(entry: Entry) -> list[int]:
-    query = "SELECT h8s FROM imagehash WHERE id = ?"
-    for [h8s] in db.execute_sql(query, [entry_key(entry)]):
-        return [int(h8, 16) for h8 in h8s.split()]
-    return []
-
-
-def image_hash(image: Image, size: int) -> str:
-    return str(imagehash.phash(image, hash_size=size))
-
-
-def trim_borders(image: Image):
-    width, height = image.size
-    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
-    difference = ImageChops.difference(image, background)
-    difference = ImageChops.add(difference, difference, 2.0, -100)
-    bbox = difference.getbbox()
-    if bbox and bbox != (0, 0, width, height):
-        return image.crop(bbox)
-
-
-def entry_candidate_images(entry: Entry) -> list[Image]:
-    base_images = [
-        Image.open(io.BytesIO(data))
-        for data in entry_thumbnails(entry)
-    ]
-
-    # Remove borders.
-    images = base_images.copy()
-    for image in base_images:
-        trimmed = trim_borders(image)
-        if trimmed:
-            images.append(trimmed)
-    base_images = images
-
-    # Consider orientations.
-    images = base_images.copy()
-    for image in base_images:
-        width, height = image.size
-        if width > height:
-            # Image is landscape so append left half.
-            images.append(image.crop((0, 0, width // 2, height)))
-
-            # Try rotating clockwise and anti-clockwise.
-            images.append(image.rotate(angle=270, expand=True))
-            images.append(image.rotate(angle=90, expand=True))
-    return images
-
-
-def process_entry(entry: Entry):
+    return load_hash_table().get(entry_key(entry)).tolist()
+
+
+# Fine hashes are ordered as `entry_h8s`.
+def entry_h16s(entry: Entry) -> list[int]:
+    return [int.from_bytes(row.tobytes(), "big")
+            for row in load_hash_table().get_fine(entry_key(entry))]
+
+
+# Repeated thumbnails do not change the hashes, such as a chapter that uses its manga cover.
+def unique_thumbnails(thumbnails: Optional[list[bytes]]) -> list[bytes]:
+    return list(dict.fromkeys(thumbnails or []))
+
+
+def thumbnails_digest(thumbnails: list[bytes]) -> str:
+    digest = hashlib.blake2b(str(HASH_VERSION).encode(), digest_size=DIGEST_SIZE)
+    for data in thumbnails:
+        digest.update(hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest())
+    return digest.hexdigest()
+
+
+# Jobs are `(digest, thumbnails)` so that workers never touch the databases.
+HashJob = tuple[str, list[bytes]]
+
+
+def process_job(job: HashJob) -> tuple[str, bytes, bytes]:
+    digest, thumbnails = job
     try:
-        images = entry_candidate_images(entry)
-        h8s = [image_hash(image, size=8) for image in images]
-        h8s = " ".join(list(dict.fromkeys(h8s)))
-        return ImageHash(id=entry_key(entry), h8s=h8s)
+        images = candidate_images(thumbnails)
+        h16s = {}
+        for h8, h16 in zip(image_hashes(images, size=HASH_SIZE), image_hashes(images, size=FINE_HASH_SIZE)):
+            h16s.setdefault(h8, h16)
+        return digest, pack_hashes(list(h16s.keys())), pack_fine_hashes(list(h16s.values()))
     except PIL.UnidentifiedImageError:
-        pass
+        return digest, b"", b""
 
 
+# Results are yielded in job order.
+# At most `HASH_WINDOW` jobs are held in memory at once.
+def hash_jobs(jobs: Iterable[HashJob]) -> Iterator[tuple[str, bytes, bytes]]:
+    if HASH_WORKERS <= 1:
+        yield from map(process_job, jobs)
+        return
+
+    with ProcessPoolExecutor(HASH_WORKERS) as executor:
+        window = collections.deque()
+        for job in jobs:
+            window.append(executor.submit(process_job, job))
+            if len(window) >= HASH_WINDOW:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def create_tables():
+    # Tables from older layouts must be rehashed in full.
+    for model in [ThumbnailHash, ImageHash]:
+        table = model._meta.table_name
+        if db.table_exists(table):
+            columns = {column.name for column in db.get_columns(table)}
+            if columns != set(model._meta.columns.keys()):
+                db.drop_tables([model])
+    db.create_tables([ThumbnailHash, ImageHash])
+
+
+# Only thumbnails that have not been hashed before are hashed.
 def main():
     db.connect()
     with db.atomic():
-        db.drop_tables([ImageHash])
-        db.create_tables([ImageHash])
+        create_tables()
+        digests = dict(ImageHash.select(ImageHash.id, ImageHash.digest).tuples())
+        hashed = {digest for digest, in ThumbnailHash.select(ThumbnailHash.digest).tuples()}
+        keys = set()
 
         sources = [
-            EHEntry.select(),
-            DBEntry.select(),
-            DSEntry.select(),
-            all_md_chapters(),
-            OrgEntry.select(),
-            CTHEntry.select(),
-            mb_entries(),
-            tora_entries(),
+            ("eh", EHEntry.select),
+            ("db", DBEntry.select),
+            ("ds", DSEntry.select),
+            ("md", all_md_chapters),
+            ("org", OrgEntry.select),
+            ("cth", CTHEntry.select),
+            ("mb", mb_entries),
+            ("tora", tora_entries),
         ]
 
-        for source in sources:
-            hashes = thread_map(process_entry, source)
-            ImageHash.bulk_create(filter(None, hashes))
+        for name, source in sources:
+            with stage(name) as record:
+                references = []
+
+                def new_jobs() -> Iterator[HashJob]:
+                    for entry in source():
+                        key = entry_key(entry)
+                        thumbnails = unique_thumbnails(entry_thumbnails(entry))
+                        digest = thumbnails_digest(thumbnails)
+                        keys.add(key)
+                        if digests.get(key) != digest:
+                            references.append((key, digest))
+                        if digest not in hashed:
+                            hashed.add(digest)
+                            yield digest, thumbnails
+
+                record.rows = 0
+                rows = tqdm(hash_jobs(new_jobs()), desc=name)
+                for batch in chunked(rows, HASH_BATCH_SIZE):
+                    (ThumbnailHash
+                     .insert_many(batch, [
+                         ThumbnailHash.digest,
+                         ThumbnailHash.hashes,
+                         ThumbnailHash.fine_hashes,
+                     ])
+                     .on_conflict_replace()
+                     .execute())
+                    record.count(len(batch))
+
+                for batch in chunked(references, HASH_BATCH_SIZE):
+                    (ImageHash
+                     .insert_many(batch, [ImageHash.id, ImageHash.digest])
+                     .on_conflict_replace()
+                     .execute())
+                print(f"[hash/{name}] {len(references)} changed, {record.rows} hashed")
+
+        # Remove hashes for entries that no longer exist.
+        vanished = list(digests.keys() - keys)
+        print(f"[hash/vanished] {len(vanished)}")
+        for batch in chunked(vanished, 500):
+            ImageHash.delete().where(ImageHash.id << batch).execute()
+
+        # Remove hashes that no entry refers to.
+        (ThumbnailHash
+         .delete()
+         .where(ThumbnailHash.digest.not_in(ImageHash.select(ImageHash.digest)))
+         .execute())
+    load_hash_table.cache_clear()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,39 @@
+import os
+
+import numpy
+
+from .build_image_hashes import load_hash_table
+from .image_search import INDEX_PATH
+from .index import IndexEntry
+
+
+# Pairs each hash with the book of its entry, sorted by hash.
+def image_search_pairs() -> numpy.ndarray:
+    load_hash_table.cache_clear()
+    table = load_hash_table()
+    entry_books = dict(IndexEntry.select(IndexEntry.id, IndexEntry.book).tuples())
+    key_books = numpy.array([entry_books.get(key, -1) for key in table.keys.tolist()],
+                            dtype=numpy.int64)
+
+    # Expand each key into one position per hash.
+    counts = table.starts[table.rows + 1] - table.starts[table.rows]
+    offsets = numpy.repeat(table.starts[table.rows] - (numpy.cumsum(counts) - counts), counts)
+    positions = offsets + numpy.arange(counts.sum())
+    hashes = table.hashes[positions]
+    books = numpy.repeat(key_books, counts)
+
+    # Entries that are not in the index have no book.
+    pairs = numpy.stack([hashes, books.astype(numpy.uint64)], axis=1)[books >= 0]
+    return numpy.ascontiguousarray(numpy.unique(pairs, axis=0).T)
+
+
+def save_image_search_index() -> int:
+    pairs = image_search_pairs()
+
+    # Replace atomically as web workers may be mapping the file.
+    temporary_path = f"{INDEX_PATH}.tmp"
+    with open(temporary_path, "wb") as f:
+        numpy.save(f, pairs)
+    os.replace(temporary_path, INDEX_PATH)
+    print(f"[image_search/save] {pairs.shape[1]} hashes")
+    return pairs.shape[1]
@@ -1,4 +1,5 @@
 import itertools
+from typing import Callable
 
 from tqdm import tqdm
 from scipy.cluster.hierarchy import DisjointSet
@@ -6,13 +7,17 @@ from scipy.cluster.hierarchy import DisjointSet
 from scripts.source_ds import filter_ds_entries
 from scripts.source_mb import mb_entries
 from scripts.source_tora import tora_entries
+from .build_report import stage
+from .bulk_writer import BulkWriter
 from .character_index import CharacterIndex, PairingIndex
 from .source_md import all_md_chapters
 from .entry import *
 from .entry_list_image_tree import EntryListImageTree
+from .build_image_search import save_image_search_index
 from .index import *
 from .source_db import filter_db_entries
 from .source_eh import gallery_circles, gallery_artists, filter_eh_entries
+from .utility import select_without_thumbnail
 
 
 def form_gallery_groups() -> EntryListImageTree:
@@ -174,30 +179,102 @@ def coalesce_book_series(lists: list[EntryList]) -> list[tuple[EntrySeries, list
     return list(roots.values())
 
 
-def main():
+def form_book_groups() -> list[EntryList]:
     # Form groups based on thumbnail similarity.
-    tree = form_gallery_groups()
-    for entry in tqdm(filter_db_entries()):
-        tree.add_or_create(entry, similarity=0.9)
-    for entry in tqdm(filter_ds_entries()):
-        tree.add_or_create(entry, similarity=0.9)
-    for entry in tqdm(all_md_chapters()):
-        tree.add_or_create(entry, similarity=0.9)
-    for entry in tqdm(OrgEntry.select()):
-        tree.add_or_create(entry, similarity=0.9)
-    for entry in tqdm(CTHEntry.select()):
-        tree.add_or_create(entry, similarity=0.9)
-    for entry in tqdm(mb_entries()):
-        tree.add_or_create(entry, similarity=0.9)
-    for entry in tqdm(tora_entries()):
-        tree.add_or_create(entry, similarity=0.9)
+    # Thumbnails are not needed for grouping so they are left unread.
+    with stage("eh"):
+        tree = form_gallery_groups()
+
+    sources = [
+        ("db", filter_db_entries),
+        ("ds", filter_ds_entries),
+        ("md", lambda: all_md_chapters(thumbnails=False)),
+        ("org", lambda: select_without_thumbnail(OrgEntry)),
+        ("cth", lambda: select_without_thumbnail(CTHEntry)),
+        ("mb", lambda: mb_entries(thumbnails=False)),
+        ("tora", lambda: tora_entries(thumbnails=False)),
+    ]
+
+    for name, source in sources:
+        with stage(name) as record:
+            record.rows = 0
+            for entry in tqdm(source()):
+                tree.add_or_create(entry, similarity=0.9)
+                record.count(1)
     lists = tree.all_entry_lists()
 
     # Add linked entries to each group.
     # This includes Pixiv sources.
-    for entry_list in lists:
-        for entry in entry_list.entries.copy():
-            entry_list.entries += linked_entries(entry)
+    with stage("linked"):
+        for entry_list in lists:
+            for entry in entry_list.entries.copy():
+                entry_list.entries += linked_entries(entry)
+    return lists
+
+
+# Book IDs are the indices of each entry list.
+def thumbnail_rows(lists: list[EntryList]):
+    for item in tqdm(lists):
+        entry = entry_list_canonical(item)
+        yield entry_key(entry), entry_thumbnail(entry)
+
+
+def series_rows(series_pools: list[tuple[EntrySeries, list[int]]]):
+    for index, (series, _book_ids) in enumerate(series_pools):
+        yield index, series.title, series.comments
+
+
+def book_rows(lists: list[EntryList], book_series: dict[int, int]):
+    for index, item in enumerate(tqdm(lists)):
+        entry = entry_list_canonical(item)
+        main_title = entry_book_titles(entry)[0]
+        yield index, main_title, book_series.get(index, None), entry_key(entry)
+
+
+def book_title_rows(lists: list[EntryList]):
+    for index, item in enumerate(tqdm(lists)):
+        all_titles = itertools.chain(*[entry_book_titles(entry) for entry in item.entries])
+        for title in set(all_titles):
+            yield index, title
+
+
+def book_description_rows(lists: list[EntryList]):
+    for index, item in enumerate(tqdm(lists)):
+        for name, details in entry_list_descriptions(item).items():
+            yield index, name, details
+
+
+# Distinct names are collected while rows are streamed
+# so that they can be written once all books are processed.
+def book_name_rows(lists: list[EntryList], names: set[str], list_names: Callable[[EntryList], list[str]]):
+    for index, item in enumerate(tqdm(lists)):
+        for name in list_names(item):
+            names.add(name)
+            yield index, name
+
+
+def entry_rows(lists: list[EntryList], languages: set[str]):
+    for index, item in enumerate(tqdm(lists)):
+        for entry in item.entries:
+            language = entry_language(entry)
+            if language:
+                languages.add(language)
+
+            yield (
+                entry_key(entry),
+                index,
+                entry_title(entry),
+                entry_url(entry),
+                entry_date_sanitized(entry),
+                language,
+                entry_page_count_sanitized(entry),
+                entry_comments(entry),
+            )
+
+
+def main():
+    with stage("grouping"):
+        lists = form_book_groups()
 
     # Construct database.
     tables = [
@@ -216,114 +293,97 @@ def main():
         IndexLanguage,
     ]
 
+    writer = BulkWriter(db)
     db.connect()
-    character_index = CharacterIndex()
-    pairing_index = PairingIndex(character_index)
-    series_pools = coalesce_book_series(lists)
-    batch_size = 10000
+    writer.use_build_pragmas()
+    with stage("canonicalization"):
+        character_index = CharacterIndex()
+        pairing_index = PairingIndex(character_index)
+        series_pools = coalesce_book_series(lists)
 
     with db.atomic():
-        db.drop_tables(tables)
-        db.create_tables(tables)
-
-        thumbnails = [IndexThumbnail(
-            id=entry_key(entry_list_canonical(item)),
-            data=entry_thumbnails(entry_list_canonical(item))[0],
-        ) for item in tqdm(lists)]
-        IndexThumbnail.bulk_create(thumbnails, batch_size)
-
-        series, book_series = [], {}
-        for index, (model, book_ids) in enumerate(series_pools):
-            model = IndexSeries(
-                id=index,
-                title=model.title,
-                comments=model.comments,
-            )
-
-            series.append(model)
-            for book in book_ids:
-                book_series[book] = model
-        IndexSeries.bulk_create(series, batch_size)
-
-        books, book_titles = [], []
-        for (index, item), thumbnail in zip(enumerate(tqdm(lists)), thumbnails):
-            main_title = entry_book_titles(entry_list_canonical(item))[0]
-            all_titles = itertools.chain(*[entry_book_titles(entry) for entry in item.entries])
-            all_titles = list(set(all_titles))
-
-            book = IndexBook(
-                id=index,
-                main_title=main_title,
-                series=book_series.get(index, None),
-                thumbnail=thumbnail,
-            )
-
-            books.append(book)
-            book_titles += [IndexBookTitle(book=book, title=title)
-                            for title in all_titles]
-        IndexBook.bulk_create(books, batch_size)
-        IndexBookTitle.bulk_create(book_titles, batch_size)
-
-        IndexBookDescription.bulk_create([
-            IndexBookDescription(book=book, name=name, details=details)
-            for item, book in zip(tqdm(lists), books)
-            for name, details in entry_list_descriptions(item).items()
-        ], batch_size)
-
-        all_tags, book_tags = set(), []
-        for item, book in zip(tqdm(lists), books):
-            tags = entry_list_tags(pairing_index, item)
-            all_tags.update(set(tags))
-            book_tags.extend((IndexBookTag(book=book, tag=tag) for tag in tags))
-        IndexTag.bulk_create([IndexTag(name=name) for name in all_tags], batch_size)
-        IndexBookTag.bulk_create(book_tags, batch_size)
-
-        all_characters, book_characters = set(), []
-        for item, book in zip(tqdm(lists), books):
-            characters = entry_list_characters(character_index, pairing_index, item)
-            all_characters.update(set(characters))
-            book_characters.extend((
-                IndexBookCharacter(book=book, character=character)
-                for character in characters
-            ))
-        all_character_models = [IndexCharacter(name=name) for name in all_characters]
-        IndexCharacter.bulk_create(all_character_models, batch_size)
-        IndexBookCharacter.bulk_create(book_characters, batch_size)
-
-        all_artists, book_artists = set(), []
-        for item, book in zip(tqdm(lists), books):
-            artists = entry_list_artists(item)
-            all_artists.update(set(artists))
-            book_artists.extend((IndexBookArtist(book=book, artist=artist) for artist in artists))
-        IndexArtist.bulk_create([IndexArtist(name=name) for name in all_artists], batch_size)
-        IndexBookArtist.bulk_create(book_artists, batch_size)
+        writer.create_tables(tables)
+
+        with stage("thumbnails") as record:
+            record.rows = writer.write(IndexThumbnail, [
+                IndexThumbnail.id,
+                IndexThumbnail.data,
+            ], thumbnail_rows(lists))
+
+        with stage("books") as record:
+            book_series = {}
+            for index, (_series, book_ids) in enumerate(series_pools):
+                for book in book_ids:
+                    book_series[book] = index
+            record.count(writer.write(IndexSeries, [
+                IndexSeries.id,
+                IndexSeries.title,
+                IndexSeries.comments,
+            ], series_rows(series_pools)))
+
+            record.count(writer.write(IndexBook, [
+                IndexBook.id,
+                IndexBook.main_title,
+                IndexBook.series,
+                IndexBook.thumbnail,
+            ], book_rows(lists, book_series)))
+
+        with stage("titles") as record:
+            record.rows = writer.write(IndexBookTitle, [
+                IndexBookTitle.book,
+                IndexBookTitle.title,
+            ], book_title_rows(lists))
+
+        with stage("descriptions") as record:
+            record.rows = writer.write(IndexBookDescription, [
+                IndexBookDescription.book,
+                IndexBookDescription.name,
+                IndexBookDescription.details,
+            ], book_description_rows(lists))
+
+        with stage("tags") as record:
+            all_tags = set()
+            record.count(writer.write(IndexBookTag, [IndexBookTag.book, IndexBookTag.tag], book_name_rows(
+                lists, all_tags, lambda item: entry_list_tags(pairing_index, item))))
+            record.count(writer.write(IndexTag, [IndexTag.name], ((name,) for name in all_tags)))
+
+        with stage("characters") as record:
+            all_characters = set()
+            record.count(writer.write(IndexBookCharacter, [
+                IndexBookCharacter.book,
+                IndexBookCharacter.character,
+            ], book_name_rows(
+                lists, all_characters, lambda item: entry_list_characters(character_index, pairing_index, item))))
+            record.count(writer.write(IndexCharacter, [IndexCharacter.name], ((name,) for name in all_characters)))
+
+        with stage("artists") as record:
+            all_artists = set()
+            record.count(writer.write(IndexBookArtist, [IndexBookArtist.book, IndexBookArtist.artist], book_name_rows(
+                lists, all_artists, entry_list_artists)))
+            record.count(writer.write(IndexArtist, [IndexArtist.name], ((name,) for name in all_artists)))
 
         # Entries may sometimes belong to more than one book.
-        all_languages, entries = set(), {}
-        for item, book in zip(tqdm(lists), books):
-            for entry in item.entries:
-                language = entry_language(entry)
-                if language:
-                    all_languages.add(language)
-
-                key = entry_key(entry)
-                entries[key] = IndexEntry(
-                    id=key,
-                    book=book,
-                    title=entry_title(entry),
-                    url=entry_url(entry),
-                    date=entry_date_sanitized(entry),
-                    language=entry_language(entry),
-                    page_count=entry_page_count_sanitized(entry),
-                    comments=entry_comments(entry),
-                )
-
-        all_language_models = [IndexLanguage(name=name) for name in all_languages]
-        IndexLanguage.bulk_create(all_language_models)
-        IndexEntry.bulk_create(entries.values(), batch_size)
-
-    # Fold the WAL into the database so the file mtime reflects this run.
-    db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        # The last book to include an entry takes precedence.
+        with stage("entries") as record:
+            all_languages = set()
+            record.count(writer.write(IndexEntry, [
+                IndexEntry.id,
+                IndexEntry.book,
+                IndexEntry.title,
+                IndexEntry.url,
+                IndexEntry.date,
+                IndexEntry.language,
+                IndexEntry.page_count,
+                IndexEntry.comments,
+            ], entry_rows(lists, all_languages), replace=True))
+            record.count(writer.write(IndexLanguage, [IndexLanguage.name], ((name,) for name in all_languages)))
+
+        with stage("indexes"):
+            writer.create_indexes(tables)
+    writer.finish()
+
+    with stage("image_search") as record:
+        record.rows = save_image_search_index()
 
 
 if __name__ == '__main__':
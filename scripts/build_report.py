@@ -0,0 +1,184 @@
+import contextlib
+import dataclasses
+import importlib
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Optional
+
+from peewee import SqliteDatabase
+
+from .http_client import http_metrics, print_http_metrics
+from .utility import utcnow
+
+REPORT_PATH = "data/build_report.json"
+HISTORY_LIMIT = 90
+
+# Stages from separate processes are grouped by this identifier.
+# The update script exports one identifier for each daily run.
+RUN_ID = os.environ.get("BUILD_RUN_ID") or utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Tracing allocations slows the build, so it must be enabled explicitly.
+TRACE_ALLOCATIONS = os.environ.get("BUILD_REPORT_TRACEMALLOC") == "1"
+
+
+@dataclasses.dataclass()
+class Stage:
+    name: str
+    started: str
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    # The high-water mark of the whole process when the stage ended, not of the stage alone.
+    process_peak_rss_mb: float = 0.0
+    peak_traced_mb: Optional[float] = None
+    rows: Optional[int] = None
+    # Requests made by the stage's process, by host, as given by `http_metrics`.
+    http: Optional[dict] = None
+    failed: bool = False
+
+    def count(self, rows: int):
+        self.rows = (self.rows or 0) + rows
+
+
+stages: list[Stage] = []
+
+
+def cpu_seconds() -> float:
+    # Includes worker processes that have been waited for.
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def process_peak_rss_mb() -> float:
+    # Linux reports the high-water mark in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Nested stages are named by their path, such as `build_index/titles`.
+@contextlib.contextmanager
+def stage(name: str):
+    parent = stages[-1] if stages else None
+    if parent:
+        name = f"{parent.name}/{name}"
+
+    record = Stage(name=name, started=utcnow().isoformat())
+    if TRACE_ALLOCATIONS:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if parent:
+            parent.peak_traced_mb = max(parent.peak_traced_mb or 0.0, traced_peak_mb())
+        tracemalloc.reset_peak()
+
+    stages.append(record)
+    start_wall, start_cpu = time.perf_counter(), cpu_seconds()
+    try:
+        yield record
+    except BaseException:
+        record.failed = True
+        raise
+    finally:
+        stages.pop()
+        record.wall_seconds = time.perf_counter() - start_wall
+        record.cpu_seconds = cpu_seconds() - start_cpu
+        record.process_peak_rss_mb = process_peak_rss_mb()
+        if TRACE_ALLOCATIONS:
+            record.peak_traced_mb = max(record.peak_traced_mb or 0.0, traced_peak_mb())
+            if parent:
+                parent.peak_traced_mb = max(parent.peak_traced_mb or 0.0, record.peak_traced_mb)
+
+        print(f"[report/stage] {record.name} {record.wall_seconds:.1f}s")
+        save_stage(record)
+
+
+def traced_peak_mb() -> float:
+    return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+
+
+def load_report() -> dict:
+    try:
+        with open(REPORT_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"runs": []}
+
+
+def save_stage(record: Stage):
+    report = load_report()
+    runs = report["runs"]
+    if not runs or runs[-1]["id"] != RUN_ID:
+        runs.append({"id": RUN_ID, "stages": []})
+    runs[-1]["stages"].append(dataclasses.asdict(record))
+    report["runs"] = runs[-HISTORY_LIMIT:]
+
+    # Write atomically so that a failed stage cannot corrupt the history.
+    temporary_path = f"{REPORT_PATH}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(temporary_path, REPORT_PATH)
+
+
+# Compares each stage of the latest run with the previous run.
+def print_summary():
+    runs = load_report()["runs"]
+    if not runs:
+        return
+
+    previous = {}
+    if len(runs) >= 2:
+        previous = {record["name"]: record for record in runs[-2]["stages"]}
+
+    print(f"[report/run] {runs[-1]['id']}")
+    for record in runs[-1]["stages"]:
+        line = (f"[report] {record['name']}: "
+                f"{record['wall_seconds']:.1f}s wall, "
+                f"{record['cpu_seconds']:.1f}s cpu, "
+                f"{record['process_peak_rss_mb']:.0f} MiB process peak rss")
+        if record["rows"] is not None:
+            line += f", {record['rows']} rows"
+        if record.get("http"):
+            line += f", {sum(host['requests'] for host in record['http'].values())} requests"
+        if record["name"] in previous:
+            before = previous[record["name"]]["wall_seconds"]
+            if before > 0:
+                line += f" ({record['wall_seconds'] / before - 1:+.0%} wall)"
+        if record["failed"]:
+            line += " [failed]"
+        print(line)
+
+
+def database_row_count(database: SqliteDatabase) -> int:
+    rows = 0
+    for table in database.get_tables():
+        rows += database.execute_sql(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    return rows
+
+
+# Runs `scripts.<module>.main()` as a stage.
+# Without arguments, prints a summary of the latest run.
+def main():
+    if len(sys.argv) < 2:
+        print_summary()
+        return
+
+    module_name = sys.argv[1]
+    module = importlib.import_module(f"scripts.{module_name}")
+    with stage(module_name) as record:
+        try:
+            module.main()
+        finally:
+            record.http = http_metrics() or None
+            print_http_metrics(record.http or {})
+
+        # Otherwise, count rows held by the module's database.
+        database = getattr(module, "db", None)
+        if record.rows is None and isinstance(database, SqliteDatabase):
+            record.rows = database_row_count(database)
+
+
+if __name__ == '__main__':
+    # Share stage state with the modules that import this one.
+    importlib.import_module("scripts.build_report").main()
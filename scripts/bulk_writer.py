@@ -0,0 +1,76 @@
+import os
+from typing import Iterable, Callable
+
+from peewee import SqliteDatabase, Model, Field, CharField, IntegerField, BlobField, ForeignKeyField, chunked
+
+# Values for these fields are passed to SQLite as-is.
+PLAIN_FIELDS = (CharField, IntegerField, BlobField, ForeignKeyField)
+
+
+# Writes plain tuples with `executemany` rather than constructing model
+# instances. SQLite caches the prepared statement for each query string,
+# so every chunk written to a table reuses the same statement.
+class BulkWriter:
+    database: SqliteDatabase
+    batch_size: int
+    fresh: bool
+
+    def __init__(self, database: SqliteDatabase, batch_size: int = 10000):
+        self.database = database
+        self.batch_size = batch_size
+
+        # Must be constructed before the database is connected.
+        self.fresh = not os.path.exists(database.database)
+
+    # Durability is traded for speed only when writing into a new
+    # file, as a failed build can then be discarded without harm.
+    def use_build_pragmas(self):
+        if self.fresh:
+            self.database.execute_sql("PRAGMA journal_mode = OFF")
+            self.database.execute_sql("PRAGMA synchronous = OFF")
+            self.database.execute_sql("PRAGMA cache_size = -262144")
+
+    # Secondary indexes are created by `create_indexes` after the data is loaded.
+    def create_tables(self, models: list[type[Model]]):
+        self.database.drop_tables(models)
+        for model in models:
+            model._schema.create_table(safe=False)
+
+    def create_indexes(self, models: list[type[Model]]):
+        for model in models:
+            model._schema.create_indexes(safe=False)
+
+    def write(self, model: type[Model], fields: list[Field], rows: Iterable[tuple], replace: bool = False) -> int:
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        columns = ", ".join(f'"{field.column_name}"' for field in fields)
+        placeholders = ", ".join("?" for _ in fields)
+        query = f'{verb} INTO "{model._meta.table_name}" ({columns}) VALUES ({placeholders})'
+
+        converters = [(index, field.db_value)
+                      for index, field in enumerate(fields)
+                      if not isinstance(field, PLAIN_FIELDS)]
+        if converters:
+            rows = map(lambda row: convert_row(converters, row), rows)
+
+        count = 0
+        cursor = self.database.cursor()
+        for batch in chunked(rows, self.batch_size):
+            cursor.executemany(query, batch)
+            count += len(batch)
+        return count
+
+    def finish(self):
+        # Restore durable settings so that readers open the file in WAL mode.
+        if self.fresh:
+            self.database.execute_sql("PRAGMA synchronous = NORMAL")
+            self.database.execute_sql("PRAGMA journal_mode = wal")
+
+        # Fold the WAL into the database so the file mtime reflects this run.
+        self.database.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def convert_row(converters: list[tuple[int, Callable]], row: tuple) -> list:
+    row = list(row)
+    for index, convert in converters:
+        row[index] = convert(row[index])
+    return row
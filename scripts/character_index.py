@@ -1,8 +1,17 @@
+import dataclasses
+import json
+import os
 from typing import Optional
 
+from scripts import source_db, source_ds
 from scripts.source_db import significant_characters, DBWikiPage
 from scripts.source_ds import ds_all_pairings
 
+# Compiled mappings are reused until a source database changes.
+# Increment the version when the compilation logic changes.
+COMPILED_INDEX_PATH = "data/character_index.json"
+COMPILED_INDEX_VERSION = 1
+
 
 def tag_to_name(tag: str):
     return (tag.replace("_", " ").title()
@@ -11,38 +20,31 @@ def tag_to_name(tag: str):
             .strip())
 
 
+@dataclasses.dataclass()
+class CompiledIndex:
+    unique: set[str]
+    mapping: dict[str, str]
+    pairings: dict[frozenset[str], frozenset[str]]
+
+
 class CharacterIndex:
+    compiled: CompiledIndex
     unique: set[str]
     mapping: dict[str, str]
+    canonical_names: dict[str, Optional[str]]
 
-    def __init__(self):
-        characters = significant_characters()
-        self.unique = set(map(tag_to_name, characters.keys()))
-
-        # Tokenize by most common first.
-        self.mapping = {}
-        for name, _count in characters.most_common():
-            readable_name = tag_to_name(name)
-            for token in readable_name.split():
-                if token not in self.mapping:
-                    self.mapping[token] = readable_name
-
-            # Add character aliases.
-            wiki_page = DBWikiPage.get_or_none(title=name)
-            if wiki_page:
-                other_names = wiki_page.data["other_names"]
-                for alias in other_names:
-                    if alias not in self.mapping:
-                        self.mapping[alias] = readable_name
-                    if alias.replace("・", "") not in self.mapping:
-                        self.mapping[alias.replace("・", "")] = readable_name
-
-        # Manually added mappings.
-        self.mapping["アリス"] = "Alice Margatroid"
-        self.mapping["リリ"] = "Lily White"
-        self.mapping["メディスン"] = "Medicine Melancholy"
+    def __init__(self, compiled: CompiledIndex = None):
+        self.compiled = compiled or compiled_index()
+        self.unique = self.compiled.unique
+        self.mapping = self.compiled.mapping
+        self.canonical_names = {}
 
     def find_and_canonicalize(self, name: str) -> Optional[str]:
+        if name not in self.canonical_names:
+            self.canonical_names[name] = self._find_and_canonicalize(name)
+        return self.canonical_names[name]
+
+    def _find_and_canonicalize(self, name: str) -> Optional[str]:
         if name in self.unique:
             return name
 
@@ -65,20 +67,117 @@ def canonicalize_pairing_characters(index: CharacterIndex, pairing: frozenset[st
 
 class PairingIndex:
     characters: CharacterIndex
-    mapping: dict[frozenset[str], frozenset[str]] = {}
+    mapping: dict[frozenset[str], frozenset[str]]
+    canonical_pairings: dict[frozenset[str], frozenset[str]]
 
     def __init__(self, characters: CharacterIndex):
         self.characters = characters
-        for pairing in ds_all_pairings():
-            self.mapping[canonicalize_pairing_characters(characters, pairing)] = pairing
-
-        # Manually added entries.
-        self.mapping[frozenset(["マリアリ"])] = frozenset(["Alice", "Marisa"])
-        self.mapping[frozenset(["秘封倶楽部"])] = frozenset(["Maribel", "Renko"])
+        self.mapping = characters.compiled.pairings
+        self.canonical_pairings = {}
 
     # Canonicalize to Dynasty pairing names.
     def canonicalize(self, pairing: frozenset[str]) -> frozenset[str]:
-        pairing = canonicalize_pairing_characters(self.characters, pairing)
-        if pairing in self.mapping:
-            return self.mapping[pairing]
-        return pairing
+        if pairing not in self.canonical_pairings:
+            canonical = canonicalize_pairing_characters(self.characters, pairing)
+            self.canonical_pairings[pairing] = self.mapping.get(canonical, canonical)
+        return self.canonical_pairings[pairing]
+
+
+def compile_character_mapping() -> tuple[set[str], dict[str, str]]:
+    characters = significant_characters()
+    unique = set(map(tag_to_name, characters.keys()))
+    wiki_pages = {page.title: page for page in
+                  DBWikiPage.select().where(DBWikiPage.title << list(characters.keys()))}
+
+    # Tokenize by most common first.
+    mapping = {}
+    for name, _count in characters.most_common():
+        readable_name = tag_to_name(name)
+        for token in readable_name.split():
+            if token not in mapping:
+                mapping[token] = readable_name
+
+        # Add character aliases.
+        wiki_page = wiki_pages.get(name)
+        if wiki_page:
+            other_names = wiki_page.data["other_names"]
+            for alias in other_names:
+                if alias not in mapping:
+                    mapping[alias] = readable_name
+                if alias.replace("・", "") not in mapping:
+                    mapping[alias.replace("・", "")] = readable_name
+
+    # Manually added mappings.
+    mapping["アリス"] = "Alice Margatroid"
+    mapping["リリ"] = "Lily White"
+    mapping["メディスン"] = "Medicine Melancholy"
+    return unique, mapping
+
+
+def compile_pairing_mapping(characters: CharacterIndex) -> dict[frozenset[str], frozenset[str]]:
+    mapping = {}
+    for pairing in ds_all_pairings():
+        mapping[canonicalize_pairing_characters(characters, pairing)] = pairing
+
+    # Manually added entries.
+    mapping[frozenset(["マリアリ"])] = frozenset(["Alice", "Marisa"])
+    mapping[frozenset(["秘封倶楽部"])] = frozenset(["Maribel", "Renko"])
+    return mapping
+
+
+def compile_index() -> CompiledIndex:
+    unique, mapping = compile_character_mapping()
+    characters = CharacterIndex(CompiledIndex(unique, mapping, pairings={}))
+    return CompiledIndex(unique, mapping, compile_pairing_mapping(characters))
+
+
+def compiled_index_sources() -> dict[str, float]:
+    paths = [source_db.db.database, source_ds.db.database]
+    return {path: os.stat(path).st_mtime for path in paths}
+
+
+def load_compiled_index() -> Optional[CompiledIndex]:
+    try:
+        with open(COMPILED_INDEX_PATH, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if data.get("version") != COMPILED_INDEX_VERSION:
+        return None
+    if data.get("sources") != compiled_index_sources():
+        return None
+
+    return CompiledIndex(
+        unique=set(data["unique"]),
+        mapping=data["mapping"],
+        pairings={frozenset(key): frozenset(value) for key, value in data["pairings"]},
+    )
+
+
+def save_compiled_index(compiled: CompiledIndex):
+    data = {
+        "version": COMPILED_INDEX_VERSION,
+        "sources": compiled_index_sources(),
+        "unique": sorted(compiled.unique),
+        "mapping": compiled.mapping,
+        "pairings": [[sorted(key), sorted(value)] for key, value in compiled.pairings.items()],
+    }
+
+    # Write atomically as concurrent builds may read the file.
+    temporary_path = f"{COMPILED_INDEX_PATH}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temporary_path, COMPILED_INDEX_PATH)
+
+
+def compiled_index() -> CompiledIndex:
+    compiled = load_compiled_index()
+    if compiled:
+        print("[characters/cached]")
+        return compiled
+
+    print("[characters/compile]")
+    compiled = compile_index()
+    save_compiled_index(compiled)
+    return compiled
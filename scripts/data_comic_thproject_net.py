@@ -1,22 +1,21 @@
 import datetime
-import io
 import os
 import zipfile
 from pathlib import Path
 
 import rarfile
-import requests
 from bs4 import BeautifulSoup
 from peewee import SqliteDatabase, Model, IntegerField, CharField, BlobField
 from tqdm.contrib.concurrent import thread_map, process_map
-from PIL import Image
 
 from scripts.date_time_utc_field import DateTimeUTCField
-from scripts.utility import HEADERS
+from scripts.http_client import HttpClient
+from scripts.utility import create_thumbnail
 
 DATA_DOWNLOAD_FOLDER = Path("data/cth")
 ENTRY_INDICES = list(range(1, 1255))
 
+client = HttpClient()
 db = SqliteDatabase("data/cth.db")
 
 
@@ -51,10 +50,7 @@ def build_entry(index: int):
     # Read and transcode cover.
     try:
         with open(DATA_DOWNLOAD_FOLDER / f"{index}.jpg", "rb") as f:
-            result = io.BytesIO()
-            cover = Image.open(io.BytesIO(f.read()))
-            cover.save(result, "jpeg")
-            thumbnail = result.getvalue()
+            thumbnail = create_thumbnail(f.read())
     except OSError:
         return
 
@@ -98,16 +94,16 @@ def download_all():
             if html_path.exists():
                 return
 
-            response = requests.get(url, headers=HEADERS, params={"id": index}).content
+            response = client.get(url, params={"id": index}).content
             html = BeautifulSoup(response.decode("GBK"), features="html.parser")
             download = html.find("a", string="HTTP下载").attrs["href"]
 
-            archive = requests.get(download, headers=HEADERS).content
+            archive = client.get(download).content
             with open(DATA_DOWNLOAD_FOLDER / f"{index}.rar", "wb") as f:
                 f.write(archive)
 
             thumbnail_url = html.find("img").attrs["src"]
-            thumbnail = requests.get(f"{base_url}/{thumbnail_url}").content
+            thumbnail = client.get(f"{base_url}/{thumbnail_url}").content
             with open(DATA_DOWNLOAD_FOLDER / f"{index}.jpg", "wb") as f:
                 f.write(thumbnail)
 
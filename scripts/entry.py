@@ -6,15 +6,16 @@ from typing import Union, Optional
 
 from .data_comic_thproject_net import CTHEntry
 from .data_doujinshi_org import OrgEntry, org_entry_release_date
-from .source_db import DBEntry, pool_translation_ratio, DBPoolDescription, DBComments, db_entry_artists, db_pixiv_id, \
+from .source_db import DBEntry, pool_translation_ratio, DBPoolDescription, DBCommentCount, db_entry_artists, db_pixiv_id, \
     pool_english_text_ratio
 from .source_ds import DSEntry, ds_entry_pairings, ds_entry_tags, ds_entry_series, ds_entry_comments, ds_entry_authors
 from .source_eh import EHEntry, gallery_artists, gallery_circles
-from .source_mb import MBDataEntry
+from .source_mb import MBDataEntry, MBEntry
 from .source_md import MDEntry, md_manga_tags, md_manga_descriptions, md_manga_comments, md_manga_titles, \
-    md_manga_authors_and_artists
+    md_manga_authors_and_artists, md_chapter_thumbnail
 from .source_px import PXEntry, get_pixiv_entry
-from .source_tora import ToraDataEntry
+from .source_tora import ToraDataEntry, ToraEntry
+from .utility import read_thumbnail
 
 Entry = Union[
     DBEntry,
@@ -135,6 +136,27 @@ def entry_thumbnails(entry: Entry) -> list[bytes]:
     return []
 
 
+# Reads the first thumbnail from the source database.
+# Works for entries that were selected without their thumbnails.
+def entry_thumbnail(entry: Entry) -> Optional[bytes]:
+    if isinstance(entry, DBEntry):
+        return read_thumbnail(DBEntry, entry.pool_id)
+    if isinstance(entry, EHEntry):
+        return read_thumbnail(EHEntry, entry.gid)
+    if isinstance(entry, DSEntry):
+        return read_thumbnail(DSEntry, entry.slug)
+    if isinstance(entry, MDEntry):
+        return md_chapter_thumbnail(entry.slug, entry.manga)
+    if isinstance(entry, OrgEntry):
+        return read_thumbnail(OrgEntry, entry.id)
+    if isinstance(entry, CTHEntry):
+        return read_thumbnail(CTHEntry, entry.id)
+    if isinstance(entry, MBDataEntry):
+        return read_thumbnail(MBEntry, entry.id)
+    if isinstance(entry, ToraDataEntry):
+        return read_thumbnail(ToraEntry, entry.id)
+
+
 def entry_date(entry: Entry) -> Optional[datetime]:
     if isinstance(entry, DBEntry):
         return datetime.fromisoformat(entry.data["created_at"])
@@ -341,7 +363,7 @@ def entry_descriptions(entry: Entry) -> dict[str, str]:
 # Only for sources that are updated regularly.
 def entry_comments(entry: Entry) -> Optional[int]:
     if isinstance(entry, DBEntry):
-        return len(DBComments.get(pool=entry).comments)
+        return DBCommentCount.get(pool=entry).count
     if isinstance(entry, DSEntry):
         if ds_entry_series(entry) is None:
             return ds_entry_comments(entry)
@@ -1,35 +1,50 @@
-import pyximport
+from typing import Optional
 
-pyximport.install()
-
-from .hamming import HammingHashList
-from .build_image_hashes import entry_h8s
+from .build_image_hashes import entry_h8s, entry_h16s
 from .entry import Entry, EntryList
+from .hamming_scanner import HammingHashList
 from .utility import deduplicate_by_identity
 
+# Coarse hashes propose candidates at a looser similarity than requested.
+# Fine hashes then confirm each candidate at the requested similarity.
+# For the same pair of images, a larger share of bits differ between 16x16 hashes than 8x8 hashes.
+COARSE_SIMILARITY_SLACK = 0.05
+FINE_DISTANCE_SCALE = 1.75
+
 
 class EntryListImageTree:
     hashes: HammingHashList
+    fine_hashes: dict[int, int]
     groups: dict[int, EntryList]
     orphans: list[Entry]
 
-    def _try_add_entry(self, h8s: list[int], group: EntryList):
-        for h8 in h8s:
+    def _try_add_entry(self, h8s: list[int], h16s: list[int], group: EntryList):
+        for h8, h16 in zip(h8s, h16s):
             if h8 not in self.groups:
                 self.groups[h8] = group
+                self.fine_hashes[h8] = h16
                 self.hashes.add(h8)
 
+    def _find_group(self, h8s: list[int], h16s: list[int], similarity: float) -> Optional[EntryList]:
+        coarse_threshold = int((1.0 - similarity + COARSE_SIMILARITY_SLACK) * (8 * 8))
+        fine_threshold = int((1.0 - similarity) * FINE_DISTANCE_SCALE * (16 * 16))
+        for h8, h16 in zip(h8s, h16s):
+            for candidate in self.hashes.find_within(h8, coarse_threshold):
+                if (self.fine_hashes[candidate] ^ h16).bit_count() <= fine_threshold:
+                    return self.groups[candidate]
+
     def __init__(self, initial_groups=None):
         if initial_groups is None:
             initial_groups = []
 
         self.hashes = HammingHashList()
+        self.fine_hashes = {}
         self.groups = {}
         self.orphans = []
 
         for group in initial_groups:
             for entry in group.entries:
-                self._try_add_entry(entry_h8s(entry), group)
+                self._try_add_entry(entry_h8s(entry), entry_h16s(entry), group)
 
     def add_or_create(self, entry: Entry, similarity: float):
         h8s = entry_h8s(entry)
@@ -37,17 +52,14 @@ class EntryListImageTree:
             self.orphans.append(entry)
             return
 
-        threshold = int((1.0 - similarity) * (8 * 8))
-        for h8 in h8s:
-            closest = self.hashes.find_closest(h8, threshold)
-            if closest is not None:
-                group = self.groups[closest]
-                group.entries.append(entry)
-                break
+        h16s = entry_h16s(entry)
+        group = self._find_group(h8s, h16s, similarity)
+        if group is not None:
+            group.entries.append(entry)
         else:
             # No match found so create new group.
             group = EntryList(entries=[entry])
-        self._try_add_entry(h8s, group)
+        self._try_add_entry(h8s, h16s, group)
 
     def all_entry_lists(self) -> list[EntryList]:
         groups = list(self.groups.values())
@@ -1,11 +1,15 @@
 # cython: language_level = 3
 
+cimport cython
+from libc.stdint cimport uint64_t
 from libcpp.utility cimport pair
 from libcpp.vector cimport vector
 from libcpp.algorithm cimport sort
-from libcpp.bit cimport popcount
 
-ctypedef unsigned long long u64
+ctypedef uint64_t u64
+
+cdef extern from "hamming_kernel.h":
+    void hamming_distances(const u64 *h8s, size_t size, u64 h8, u64 *distances) nogil
 
 # Using a vectorized linear search is significantly faster
 # than specialized metric data structures like the BKTree.
@@ -17,10 +21,7 @@ cdef class HammingHashList:
 
     def find_closest(self, h8: u64, n: u64):
         cdef vector[u64] distances = vector[u64](self.h8s.size())
-        for i in range(self.h8s.size()):
-            # Calculates the hamming distance.
-            # This must be inlined to enable vectorization.
-            distances[i] = popcount(self.h8s[i] ^ h8)
+        hamming_distances(self.h8s.data(), self.h8s.size(), h8, distances.data())
 
         cdef vector[pair[u64, u64]] candidates
         for i in range(self.h8s.size()):
@@ -30,3 +31,41 @@ cdef class HammingHashList:
         if not candidates.empty():
             sort(candidates.begin(), candidates.end())
             return candidates[0].second
+
+    # Returns every hash within `n`, closest first.
+    def find_within(self, h8: u64, n: u64):
+        cdef vector[u64] distances = vector[u64](self.h8s.size())
+        hamming_distances(self.h8s.data(), self.h8s.size(), h8, distances.data())
+
+        cdef vector[pair[u64, u64]] candidates
+        for i in range(self.h8s.size()):
+            if distances[i] <= n:
+                candidates.push_back(pair[u64, u64](distances[i], self.h8s[i]))
+
+        sort(candidates.begin(), candidates.end())
+        return [candidate.second for candidate in candidates]
+
+
+# Scans hashes held by another object, such as a memory-mapped file, without copying them.
+cdef class HammingHashView:
+    cdef const u64[::1] h8s
+
+    def __init__(self, const u64[::1] h8s):
+        self.h8s = h8s
+
+    # Returns `(distance, position)` for every hash within `n`, closest first.
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def find_within(self, h8: u64, n: u64):
+        cdef Py_ssize_t i
+        cdef vector[u64] distances = vector[u64](self.h8s.shape[0])
+        if self.h8s.shape[0]:
+            hamming_distances(&self.h8s[0], self.h8s.shape[0], h8, distances.data())
+
+        cdef vector[pair[u64, u64]] candidates
+        for i in range(self.h8s.shape[0]):
+            if distances[i] <= n:
+                candidates.push_back(pair[u64, u64](distances[i], i))
+
+        sort(candidates.begin(), candidates.end())
+        return [(candidate.first, candidate.second) for candidate in candidates]
@@ -0,0 +1,17 @@
+#include <bit>
+#include <cstddef>
+#include <cstdint>
+
+// Compiled once for each target and selected for the running CPU when the extension loads.
+#if defined(__x86_64__) && defined(__linux__)
+#define HAMMING_TARGETS __attribute__((target_clones("avx2", "popcnt", "default")))
+#else
+#define HAMMING_TARGETS
+#endif
+
+HAMMING_TARGETS
+static void hamming_distances(const uint64_t *h8s, size_t size, uint64_t h8, uint64_t *distances) {
+    for (size_t i = 0; i < size; i++) {
+        distances[i] = std::popcount(h8s[i] ^ h8);
+    }
+}
@@ -0,0 +1,72 @@
+import numpy
+
+# Same interface as the compiled `hamming` extension, for machines without a compiler.
+
+M1 = numpy.uint64(0x5555555555555555)
+M2 = numpy.uint64(0x3333333333333333)
+M4 = numpy.uint64(0x0F0F0F0F0F0F0F0F)
+H01 = numpy.uint64(0x0101010101010101)
+
+
+def popcount(x: numpy.ndarray) -> numpy.ndarray:
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(x).astype(numpy.uint64)
+
+    # Counts bits in parallel within each integer.
+    x = x - ((x >> numpy.uint64(1)) & M1)
+    x = (x & M2) + ((x >> numpy.uint64(2)) & M2)
+    x = (x + (x >> numpy.uint64(4))) & M4
+    return (x * H01) >> numpy.uint64(56)
+
+
+def hamming_distances(h8s: numpy.ndarray, h8: int) -> numpy.ndarray:
+    return popcount(numpy.bitwise_xor(h8s, numpy.uint64(h8)))
+
+
+class HammingHashList:
+    h8s: numpy.ndarray
+    size: int
+
+    def __init__(self):
+        self.h8s = numpy.zeros(1024, dtype=numpy.uint64)
+        self.size = 0
+
+    def add(self, h8: int):
+        if self.size == len(self.h8s):
+            self.h8s = numpy.concatenate([self.h8s, numpy.zeros_like(self.h8s)])
+        self.h8s[self.size] = h8
+        self.size += 1
+
+    def _within(self, h8: int, n: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        h8s = self.h8s[:self.size]
+        distances = hamming_distances(h8s, h8)
+        matches = distances <= n
+        distances, h8s = distances[matches], h8s[matches]
+        order = numpy.lexsort((h8s, distances))
+        return distances[order], h8s[order]
+
+    def find_closest(self, h8: int, n: int):
+        _distances, h8s = self._within(h8, n)
+        if len(h8s):
+            return int(h8s[0])
+
+    # Returns every hash within `n`, closest first.
+    def find_within(self, h8: int, n: int) -> list[int]:
+        _distances, h8s = self._within(h8, n)
+        return h8s.tolist()
+
+
+# Scans hashes held by another object, such as a memory-mapped file, without copying them.
+class HammingHashView:
+    h8s: numpy.ndarray
+
+    def __init__(self, h8s):
+        self.h8s = numpy.asarray(h8s, dtype=numpy.uint64)
+
+    # Returns `(distance, position)` for every hash within `n`, closest first.
+    def find_within(self, h8: int, n: int) -> list[tuple[int, int]]:
+        distances = hamming_distances(self.h8s, h8)
+        positions = numpy.flatnonzero(distances <= n)
+        distances = distances[positions]
+        order = numpy.lexsort((positions, distances))
+        return list(zip(distances[order].tolist(), positions[order].tolist()))
@@ -0,0 +1,10 @@
+# Prefers the extension compiled by `python -m scripts.compile_hamming`.
+try:
+    from .hamming import HammingHashList, HammingHashView
+
+    IMPLEMENTATION = "extension"
+except ImportError:
+    from .hamming_numpy import HammingHashList, HammingHashView
+
+    IMPLEMENTATION = "numpy"
+    print("[hamming/numpy] compiled extension not found, using NumPy fallback")
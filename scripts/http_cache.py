@@ -0,0 +1,90 @@
+import dataclasses
+import functools
+import hashlib
+from typing import Optional
+
+import requests
+from peewee import SqliteDatabase, Model, CharField
+
+from .http_client import HttpClient
+
+db = SqliteDatabase("data/http_cache.db")
+
+
+# Validators of listing pages as they were when last processed in full.
+# Pages are compared by digest when the host does not answer conditional requests.
+class PageValidator(Model):
+    url = CharField(primary_key=True)
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    digest = CharField()
+
+    class Meta:
+        database = db
+        without_rowid = True
+
+
+# Content is only given for pages that changed.
+@dataclasses.dataclass()
+class Page:
+    url: str
+    changed: bool
+    content: Optional[bytes]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    digest: Optional[str] = None
+
+
+@functools.cache
+def create_tables():
+    db.create_tables([PageValidator])
+
+
+def page_url(url: str, params: dict = None) -> str:
+    return requests.Request("GET", url, params=params).prepare().url
+
+
+def content_digest(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+# Requests a page unless it is unchanged since it was last saved with `save_page`.
+# Pages that are not `conditional` are always given as changed, but can still be saved.
+# Error responses are given as changed, and are never saved.
+def fetch_page(client: HttpClient, url: str, params: dict = None, conditional: bool = True) -> Page:
+    create_tables()
+    url = page_url(url, params)
+    cached = PageValidator.get_or_none(PageValidator.url == url) if conditional else None
+
+    headers = {}
+    if cached and cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached and cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+
+    response = client.get(url, headers=headers)
+    if cached and response.status_code == 304:
+        print(f"[cache/unchanged] {url}")
+        return Page(url, False, None)
+    if not response.ok:
+        return Page(url, True, response.content)
+
+    digest = content_digest(response.content)
+    if cached and cached.digest == digest:
+        print(f"[cache/unchanged] {url}")
+        return Page(url, False, None)
+    return Page(url, True, response.content,
+                response.headers.get("ETag"), response.headers.get("Last-Modified"), digest)
+
+
+# Called once a changed page has been processed, so that pages are processed again if that failed.
+def save_page(page: Page):
+    if not page.changed or page.digest is None:
+        return
+    create_tables()
+    PageValidator.replace(
+        url=page.url,
+        etag=page.etag,
+        last_modified=page.last_modified,
+        digest=page.digest,
+    ).execute()
@@ -0,0 +1,128 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from peewee import SqliteDatabase, Model, CharField, IntegerField, BlobField
+from playhouse.sqlite_ext import JSONField
+from requests import PreparedRequest, Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Set `HTTP_MODE=record` to save every response to the cassette at `HTTP_CASSETTE`,
+# or `HTTP_MODE=replay` to serve responses from it instead of the network.
+# Set `HTTP_REPLAY_LATENCY` to delay each replayed response by that many seconds.
+HTTP_MODE = os.environ.get("HTTP_MODE")
+HTTP_CASSETTE = os.environ.get("HTTP_CASSETTE") or "data/cassette.db"
+HTTP_REPLAY_LATENCY = float(os.environ.get("HTTP_REPLAY_LATENCY") or 0)
+
+# Left out of recorded URLs, such as API keys.
+SECRET_PARAMS = {"x-api-key"}
+
+# Conditional requests, such as those of `http_cache.fetch_page`, are recorded apart
+# from unconditional requests to the same URL, as they are answered differently.
+KEYED_HEADERS = ("If-None-Match", "If-Modified-Since")
+
+# Bodies are stored decoded.
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+db = SqliteDatabase(None)
+lock = threading.Lock()
+
+
+# Responses are keyed by their request, so a request made twice keeps its last response.
+class CassetteResponse(Model):
+    key = CharField(primary_key=True)
+    method = CharField()
+    url = CharField()
+    status = IntegerField()
+    headers = JSONField()
+    body = BlobField()
+
+    class Meta:
+        database = db
+        without_rowid = True
+
+
+class CassetteMissError(requests.exceptions.RequestException):
+    pass
+
+
+def request_key(request: PreparedRequest) -> tuple[str, str]:
+    parts = urlsplit(request.url)
+    query = urlencode([(name, value)
+                       for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                       if name not in SECRET_PARAMS])
+    url = parts._replace(query=query).geturl()
+
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode()
+    digest = hashlib.blake2b(f"{request.method} {url}".encode(), digest_size=16)
+    digest.update(hashlib.blake2b(body, digest_size=16).digest())
+    for name in KEYED_HEADERS:
+        if request.headers.get(name):
+            digest.update(f"{name}: {request.headers[name]}".encode())
+    return digest.hexdigest(), url
+
+
+class RecordingAdapter(BaseAdapter):
+    def __init__(self, adapter: BaseAdapter):
+        super().__init__()
+        self.adapter = adapter
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        response = self.adapter.send(request, **kwargs)
+        key, url = request_key(request)
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() not in DROPPED_HEADERS}
+        with lock:
+            CassetteResponse.replace(
+                key=key,
+                method=request.method,
+                url=url,
+                status=response.status_code,
+                headers=headers,
+                body=response.content,
+            ).execute()
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        key, url = request_key(request)
+        recorded = CassetteResponse.get_or_none(CassetteResponse.key == key)
+        if recorded is None:
+            raise CassetteMissError(f"not recorded: {request.method} {url}", request=request)
+        time.sleep(HTTP_REPLAY_LATENCY)
+
+        response = Response()
+        response.status_code = recorded.status
+        response.headers = CaseInsensitiveDict(recorded.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(recorded.body)
+        response._content = bytes(recorded.body)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+# Wraps the adapter of a client for the mode in `HTTP_MODE`.
+def cassette_adapter(adapter: BaseAdapter) -> BaseAdapter:
+    if HTTP_MODE not in ("record", "replay"):
+        return adapter
+    with lock:
+        if db.database is None:
+            db.init(HTTP_CASSETTE)
+            db.create_tables([CassetteResponse])
+    return RecordingAdapter(adapter) if HTTP_MODE == "record" else ReplayAdapter()
@@ -0,0 +1,316 @@
+import collections
+import dataclasses
+import os
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlencode, urlparse
+
+import requests
+from requests import Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.util import create_urllib3_context
+
+from .http_cassette import HTTP_MODE, cassette_adapter
+from .utility import HEADERS, OutOfCreditsError, tracing_response_hook
+
+# Statuses that are retried unless a host sets its own.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Retries wait `backoff * 2 ** attempt` seconds, up to this limit,
+# unless the response asks for a longer wait through `Retry-After`.
+BACKOFF_LIMIT_SECONDS = 60.0
+
+
+# How requests to one host are made.
+# Rate limits are requests per second, spaced evenly rather than sent in bursts.
+# Routes are limited by the first segment of their path, in addition to the host.
+@dataclasses.dataclass(frozen=True)
+class HostPolicy:
+    rate: Optional[float] = None
+    routes: dict[str, float] = dataclasses.field(default_factory=dict)
+    connections: int = 10
+    retries: int = 5
+    backoff: float = 0.5
+    retry_statuses: frozenset[int] = RETRY_STATUSES
+    timeout: float = 60.0
+    # OpenSSL cipher list, for hosts that only offer outdated ciphers.
+    ciphers: Optional[str] = None
+
+
+class CipherAdapter(HTTPAdapter):
+    def __init__(self, ciphers: str, **kwargs):
+        self.ciphers = ciphers
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = create_urllib3_context(ciphers=self.ciphers)
+        return super().init_poolmanager(*args, **kwargs)
+
+
+# Token bucket shared by threads, holding at most one token.
+# Tokens are reserved in order, so waiting threads sleep without holding the lock.
+# Hosts such as MangaDex also report the requests remaining until their window
+# resets, which are spent alongside the tokens until then.
+# Requests in flight are not counted by the host yet, so they are subtracted.
+class RateLimiter:
+    interval: float
+    next_time: float
+    remaining: Optional[int]
+    resets_at: float
+    pending: int
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_time = time.monotonic()
+        self.remaining = None
+        self.resets_at = 0.0
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+
+            # `resets_at` is a Unix timestamp, as given by MangaDex.
+            if self.remaining is not None:
+                if time.time() >= self.resets_at:
+                    self.remaining = None
+                elif self.remaining <= 0:
+                    start = max(start, now + self.resets_at - time.time())
+                    self.remaining = None
+                else:
+                    self.remaining -= 1
+
+            self.next_time = start + self.interval
+            self.pending += 1
+        time.sleep(start - now)
+
+    # Called once for each acquired token, without a response if the request failed.
+    def release(self, response: Response = None):
+        with self.lock:
+            self.pending -= 1
+            if response is None:
+                return
+
+            remaining = response.headers.get("X-RateLimit-Remaining")
+            resets_at = response.headers.get("X-RateLimit-Retry-After")
+            if remaining is None or resets_at is None:
+                return
+
+            remaining = 0 if response.status_code == 429 else int(remaining) - self.pending
+            resets_at = float(resets_at)
+            if self.remaining is None or resets_at > self.resets_at:
+                self.remaining, self.resets_at = remaining, resets_at
+            elif resets_at == self.resets_at:
+                self.remaining = min(self.remaining, remaining)
+
+
+@dataclasses.dataclass()
+class HostMetrics:
+    requests: int = 0
+    retries: int = 0
+    errors: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    statuses: collections.Counter = dataclasses.field(default_factory=collections.Counter)
+
+    def merge(self, other: "HostMetrics"):
+        self.requests += other.requests
+        self.retries += other.retries
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+        self.statuses.update(other.statuses)
+
+    def summary(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "mean_seconds": self.seconds / self.requests if self.requests else 0.0,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+        }
+
+
+# Every client, so that metrics can be reported for the whole process.
+clients: list["HttpClient"] = []
+
+
+# Shares a session between threads, with a connection pool, rate limit and
+# retry policy for each host. Hosts without a policy use `default`.
+# Responses are returned once they succeed or their retries run out,
+# and connection errors are raised once their retries run out.
+# Replayed responses are served without rate limits or waiting between retries.
+class HttpClient:
+    policies: dict[str, HostPolicy]
+    default: HostPolicy
+    session: requests.Session
+    limiters: dict[tuple[str, Optional[str]], RateLimiter]
+    metrics: dict[str, HostMetrics]
+
+    def __init__(self, policies: dict[str, HostPolicy] = None, default: HostPolicy = HostPolicy()):
+        self.policies = policies or {}
+        self.default = default
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.hooks["response"].append(tracing_response_hook)
+        self.limiters = {}
+        self.metrics = collections.defaultdict(HostMetrics)
+        self.lock = threading.Lock()
+
+        for prefix in ["https://", "http://"]:
+            self.session.mount(prefix, self.adapter(default))
+        for host, policy in self.policies.items():
+            for prefix in ["https://", "http://"]:
+                self.session.mount(f"{prefix}{host}/", self.adapter(policy))
+
+        if HTTP_MODE != "replay":
+            for host, policy in [(None, default), *self.policies.items()]:
+                if policy.rate:
+                    self.limiters[host, None] = RateLimiter(policy.rate)
+                for route, rate in policy.routes.items():
+                    self.limiters[host, route] = RateLimiter(rate)
+        clients.append(self)
+
+    @staticmethod
+    def adapter(policy: HostPolicy) -> BaseAdapter:
+        if policy.ciphers:
+            return cassette_adapter(CipherAdapter(policy.ciphers, pool_maxsize=policy.connections))
+        return cassette_adapter(HTTPAdapter(pool_maxsize=policy.connections))
+
+    def policy(self, host: str) -> HostPolicy:
+        return self.policies.get(host, self.default)
+
+    # Hosts without a policy share the default rate limit.
+    # The route is acquired first, so that waiting on it does not hold a host token.
+    def request_limiters(self, host: str, path: str) -> list[RateLimiter]:
+        host = host if host in self.policies else None
+        route = path.split("/")[1] if path.count("/") >= 1 else ""
+        return [limiter for limiter in [self.limiters.get((host, route)), self.limiters.get((host, None))]
+                if limiter]
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        parsed = urlparse(url)
+        policy = self.policy(parsed.hostname)
+        limiters = self.request_limiters(parsed.hostname, parsed.path)
+        kwargs.setdefault("timeout", policy.timeout)
+
+        attempt = 0
+        while True:
+            for limiter in limiters:
+                limiter.acquire()
+
+            # Only the most specific limiter is told the remaining requests.
+            response = None
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                self.record(parsed.hostname, time.perf_counter() - started, None, attempt)
+                if attempt >= policy.retries:
+                    raise
+                print(f"[http/retry] {url} {error.__class__.__name__}")
+            else:
+                self.record(parsed.hostname, time.perf_counter() - started, response, attempt)
+                if response.status_code not in policy.retry_statuses or attempt >= policy.retries:
+                    return response
+                print(f"[http/retry/{response.status_code}] {url}")
+            finally:
+                for index, limiter in enumerate(limiters):
+                    limiter.release(response if index == 0 else None)
+
+            if HTTP_MODE != "replay":
+                time.sleep(retry_delay(policy, attempt, response))
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> Response:
+        return self.request("POST", url, **kwargs)
+
+    def record(self, host: str, seconds: float, response: Optional[Response], attempt: int):
+        with self.lock:
+            metrics = self.metrics[host]
+            metrics.requests += 1
+            metrics.retries += attempt > 0
+            metrics.seconds += seconds
+            if response is None:
+                metrics.errors += 1
+            else:
+                metrics.bytes += len(response.content)
+                metrics.statuses[response.status_code] += 1
+
+
+def retry_delay(policy: HostPolicy, attempt: int, response: Optional[Response]) -> float:
+    delay = min(policy.backoff * 2 ** attempt, BACKOFF_LIMIT_SECONDS)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+    return delay
+
+
+# Requests, bytes, latency and statuses for each host, across every client.
+def http_metrics() -> dict[str, dict]:
+    merged = collections.defaultdict(HostMetrics)
+    for client in clients:
+        with client.lock:
+            for host, metrics in client.metrics.items():
+                merged[host].merge(metrics)
+    return {host: merged[host].summary() for host in sorted(merged)}
+
+
+def print_http_metrics(metrics: dict[str, dict]):
+    for host, summary in metrics.items():
+        statuses = " ".join(f"{status}x{count}" for status, count in summary["statuses"].items())
+        print(f"[http/{host}] {summary['requests']} requests, {summary['retries']} retries, "
+              f"{summary['errors']} errors, {summary['bytes'] / (1024 * 1024):.1f} MiB, "
+              f"{summary['mean_seconds']:.2f}s mean, {statuses}")
+
+
+# ScrapingAnt statuses are retried by `get_with_proxy`, which tells them apart.
+proxy_client = HttpClient({
+    "api.scrapingant.com": HostPolicy(retry_statuses=frozenset(), timeout=180.0),
+})
+
+
+def get_with_proxy(
+    url: str,
+    retries: int,
+    params: dict[str, str | int] = None,
+    with_browser: bool = False,
+    proxy_country: str = None,
+):
+    request_params = {
+        "url": f"{url}?{urlencode(params or {})}",
+        "x-api-key": os.environ["SCRAPINGANT_API_KEY"],
+    }
+
+    if with_browser:
+        request_params["return_page_source"] = "true"
+    else:
+        request_params["browser"] = "false"
+
+    if proxy_country:
+        request_params["proxy_country"] = proxy_country
+
+    attempt = 0
+    while attempt < retries:
+        response = proxy_client.get(
+            "https://api.scrapingant.com/v2/general",
+            params=request_params
+        )
+
+        if response.status_code == 200:
+            return response
+
+        # ScrapingAnt returns 403 when the plan credit limit is reached.
+        if response.status_code == 403:
+            raise OutOfCreditsError(f"credits exhausted: {request_params['url']}")
+
+        attempt += 1
+        print(f"[retry/{response.status_code}] {request_params['url']}")
+    raise ValueError(f"Failed to fetch: {request_params['url']}")
@@ -0,0 +1,79 @@
+import imagehash
+import numpy
+import scipy.fftpack
+from PIL import Image, ImageChops
+
+from .utility import load_image
+
+# Shared by the hash builder and the web app, so it must not import any source.
+# Hashes are `HASH_SIZE` bits square, and confirmed with fine hashes `FINE_HASH_SIZE` bits square.
+# Increment the version when hashes for the same thumbnails change.
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+FINE_HASH_SIZE = 16
+FINE_HASH_BYTES = FINE_HASH_SIZE * FINE_HASH_SIZE // 8
+HASH_VERSION = 4
+
+
+def image_hash(image: Image, size: int) -> str:
+    return str(imagehash.phash(image, hash_size=size))
+
+
+# Equivalent to `image_hash` for each image, with one DCT over the whole batch.
+# The hash size squared must be a multiple of eight.
+def image_hashes(images: list[Image], size: int) -> list[str]:
+    if not images:
+        return []
+
+    # Matches the resizing in `imagehash.phash`.
+    image_size = size * 4
+    pixels = numpy.stack([
+        numpy.asarray(image.convert("L").resize((image_size, image_size), Image.LANCZOS))
+        for image in images
+    ])
+
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    low_frequencies = dct[:, :size, :size].reshape(len(images), size * size)
+    medians = numpy.median(low_frequencies, axis=1, keepdims=True)
+    bits = numpy.packbits(low_frequencies > medians, axis=1)
+    return [row.tobytes().hex() for row in bits]
+
+
+def trim_borders(image: Image):
+    width, height = image.size
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    difference = ImageChops.difference(image, background)
+    difference = ImageChops.add(difference, difference, 2.0, -100)
+    bbox = difference.getbbox()
+    if bbox and bbox != (0, 0, width, height):
+        return image.crop(bbox)
+
+
+# Thumbnails are decoded in full, as decoding stored thumbnails at reduced scale
+# moves their hashes far enough to change groups.
+def candidate_images(thumbnails: list[bytes]) -> list[Image]:
+    base_images = [
+        load_image(data)
+        for data in thumbnails
+    ]
+
+    # Remove borders.
+    images = base_images.copy()
+    for image in base_images:
+        trimmed = trim_borders(image)
+        if trimmed:
+            images.append(trimmed)
+    base_images = images
+
+    # Consider orientations.
+    images = base_images.copy()
+    for image in base_images:
+        width, height = image.size
+        if width > height:
+            # Image is landscape so append left half.
+            images.append(image.crop((0, 0, width // 2, height)))
+
+            # Try rotating clockwise and anti-clockwise.
+            images.append(image.rotate(angle=270, expand=True))
+            images.append(image.rotate(angle=90, expand=True))
+    return images
@@ -0,0 +1,68 @@
+import dataclasses
+import functools
+import io
+import os
+
+import numpy
+from PIL import Image
+
+from .hamming_scanner import HammingHashView
+from .image_hashing import HASH_BITS, HASH_SIZE, candidate_images, image_hashes
+from .utility import create_thumbnail
+
+# Written by `build_image_search` and memory-mapped by each web worker,
+# so that workers share one copy through the page cache.
+# Row 0 holds sorted hashes and row 1 holds the book of each hash.
+INDEX_PATH = "data/image_search.npy"
+
+# Matches the similarity used to group entries by circle.
+MAX_DISTANCE = int((1.0 - 0.8) * HASH_BITS)
+RESULT_LIMIT = 20
+
+# Uploads are rejected above this many pixels, well below the limit at which
+# Pillow refuses to open an image, as formats other than JPEG are decoded in full.
+MAX_UPLOAD_PIXELS = 4096 * 4096
+
+
+@dataclasses.dataclass()
+class ImageSearchIndex:
+    scanner: HammingHashView
+    books: numpy.ndarray
+
+
+@dataclasses.dataclass()
+class ImageSearchResult:
+    book_id: int
+    distance: int
+
+
+# Mapped again when the file is replaced, as book identifiers change between builds.
+@functools.lru_cache(maxsize=1)
+def _image_search_index(_version: float) -> ImageSearchIndex:
+    pairs = numpy.load(INDEX_PATH, mmap_mode="r")
+    return ImageSearchIndex(HammingHashView(pairs[0]), pairs[1])
+
+
+def image_search_index() -> ImageSearchIndex:
+    return _image_search_index(os.stat(INDEX_PATH).st_mtime)
+
+
+# Ranks books by the closest hash of any candidate image, closest first.
+# Uploads are shrunk as the thumbnails of entries were, before they are hashed.
+def search_image(data: bytes, limit: int = RESULT_LIMIT) -> list[ImageSearchResult]:
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width * image.height > MAX_UPLOAD_PIXELS:
+            raise Image.DecompressionBombError(f"{image.width}x{image.height} exceeds {MAX_UPLOAD_PIXELS} pixels")
+
+    index = image_search_index()
+    h8s = list(dict.fromkeys(image_hashes(candidate_images([create_thumbnail(data)]), size=HASH_SIZE)))
+
+    distances: dict[int, int] = {}
+    for h8 in h8s:
+        for distance, position in index.scanner.find_within(int(h8, 16), MAX_DISTANCE):
+            book_id = int(index.books[position])
+            if distance < distances.get(book_id, MAX_DISTANCE + 1):
+                distances[book_id] = distance
+
+    ranked = sorted(distances.items(), key=lambda item: (item[1], item[0]))
+    return [ImageSearchResult(book_id, distance) for book_id, distance in ranked[:limit]]
@@ -0,0 +1,277 @@
+import dataclasses
+import datetime
+import math
+import os
+from typing import Callable, Iterable, Optional
+
+from peewee import SqliteDatabase, Model, CharField, IntegerField, FloatField, CompositeKey
+
+from . import source_db, source_ds, source_eh, source_mb, source_md, source_tora
+from .build_report import stage
+from .utility import utcnow, select_without_thumbnail
+
+db = SqliteDatabase("data/refresh.db")
+
+# Requests each source may spend on refreshing entries per day.
+# Override with `REFRESH_BUDGET_<SOURCE>`, such as `REFRESH_BUDGET_EH=8`.
+# MB and Tora are fetched through ScrapingAnt, which spends paid credits,
+# so they are only refreshed once given a budget.
+REFRESH_BUDGETS = {
+    "eh": 4,
+    "db": 100,
+    "ds": 200,
+    "md": 200,
+    "mb": 0,
+    "tora": 0,
+}
+
+# Set `REFRESH_DRY_RUN=1` to print the plan without requesting anything.
+# Set `REFRESH_SOURCES=eh,db` to refresh only some sources.
+REFRESH_DRY_RUN = os.environ.get("REFRESH_DRY_RUN") == "1"
+REFRESH_SOURCES = os.environ.get("REFRESH_SOURCES")
+
+# Entries are expected to change less as they age: an entry `age` days old is
+# expected to change `1 / (PRIOR_AGE_DAYS + age)` times per day. Observed changes
+# outweigh this once an entry has been watched for longer than `PRIOR_DAYS`.
+PRIOR_AGE_DAYS = 7
+PRIOR_DAYS = 30
+
+# Age assumed for entries without a publication date.
+UNKNOWN_AGE_DAYS = 365
+
+
+class BaseModel(Model):
+    class Meta:
+        database = db
+
+
+# Changes observed for each entry over the days between its refreshes.
+class RefreshState(BaseModel):
+    source = CharField()
+    key = CharField()
+    checks = IntegerField()
+    changes = IntegerField()
+    observed_days = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey("source", "key")
+
+
+class RefreshSpend(BaseModel):
+    source = CharField()
+    date = CharField()
+    requests = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey("source", "date")
+
+
+@dataclasses.dataclass()
+class RefreshSource:
+    name: str
+    database: SqliteDatabase
+    # Entries with at least their primary key, `last_fetched`, and the fields read by `cost` and `published`.
+    entries: Callable[[], Iterable[Model]]
+    # Refetches entries and saves them with a new `last_fetched`.
+    # Returns whether each entry changed, keyed by primary key, for entries that were refetched.
+    refresh: Callable[[list[Model]], dict]
+    # Requests spent to refresh an entry.
+    cost: Callable[[Model], float]
+    published: Callable[[Model], Optional[datetime.datetime]]
+
+
+def md_published(manga: source_md.MDManga) -> Optional[datetime.datetime]:
+    created_at = manga.data["attributes"].get("createdAt")
+    return created_at and datetime.datetime.fromisoformat(created_at)
+
+
+SOURCES = [
+    RefreshSource(
+        name="eh",
+        database=source_eh.db,
+        entries=lambda: select_without_thumbnail(source_eh.EHEntry),
+        refresh=source_eh.refresh_galleries,
+        # The gdata API accepts 25 galleries per request.
+        cost=lambda entry: 1 / 25,
+        published=source_eh.eh_published,
+    ),
+    RefreshSource(
+        name="db",
+        database=source_db.db,
+        entries=lambda: select_without_thumbnail(source_db.DBEntry),
+        refresh=source_db.refresh_pools,
+        cost=lambda entry: math.ceil(len(entry.data["post_ids"]) / 200) or 1,
+        published=lambda entry: source_db.db_time(entry.data["created_at"]),
+    ),
+    RefreshSource(
+        name="ds",
+        database=source_ds.db,
+        entries=lambda: select_without_thumbnail(source_ds.DSEntry),
+        refresh=source_ds.refresh_chapters,
+        cost=lambda entry: 1,
+        published=source_ds.ds_published,
+    ),
+    RefreshSource(
+        name="md",
+        database=source_md.db,
+        entries=lambda: select_without_thumbnail(source_md.MDManga),
+        refresh=source_md.refresh_feeds,
+        cost=lambda entry: 1,
+        published=md_published,
+    ),
+    # Product pages are large, so they are only read when refreshed.
+    RefreshSource(
+        name="mb",
+        database=source_mb.db,
+        entries=lambda: source_mb.MBEntry.select(source_mb.MBEntry.id, source_mb.MBEntry.last_fetched),
+        refresh=source_mb.refresh_products,
+        cost=lambda entry: 1,
+        published=lambda entry: None,
+    ),
+    RefreshSource(
+        name="tora",
+        database=source_tora.db,
+        entries=lambda: source_tora.ToraEntry.select(source_tora.ToraEntry.id, source_tora.ToraEntry.last_fetched),
+        refresh=source_tora.refresh_products,
+        cost=lambda entry: 1,
+        published=lambda entry: None,
+    ),
+]
+
+
+@dataclasses.dataclass()
+class RefreshCandidate:
+    entry: Model
+    key: str
+    cost: float
+    # Estimated changes per day.
+    rate: float
+    days_since_fetched: Optional[float]
+    # Probability that the entry changed since it was last fetched.
+    priority: float
+
+
+def days_between(start: datetime.datetime, end: datetime.datetime) -> float:
+    return max(0.0, (end - start).total_seconds() / 86400)
+
+
+def source_budget(name: str) -> float:
+    return float(os.environ.get(f"REFRESH_BUDGET_{name.upper()}") or REFRESH_BUDGETS[name])
+
+
+def spent_today(name: str, now: datetime.datetime) -> float:
+    spend = RefreshSpend.get_or_none(source=name, date=now.date().isoformat())
+    return spend.requests if spend else 0.0
+
+
+# Changes are modelled as a Poisson process for each entry. Its rate starts from a
+# prior that falls with the age of the entry and is updated by the changes observed.
+# Entries are picked by the probability that they changed per request spent.
+def plan_refresh(source: RefreshSource, now: datetime.datetime) -> list[RefreshCandidate]:
+    states = {
+        key: (changes, observed_days)
+        for key, changes, observed_days in RefreshState
+        .select(RefreshState.key, RefreshState.changes, RefreshState.observed_days)
+        .where(RefreshState.source == source.name)
+        .tuples()
+    }
+
+    candidates = []
+    for entry in source.entries():
+        key = str(entry.get_id())
+        changes, observed_days = states.get(key, (0, 0.0))
+        published = source.published(entry)
+        age = days_between(published, now) if published else UNKNOWN_AGE_DAYS
+        prior = 1 / (PRIOR_AGE_DAYS + age)
+        rate = (changes + prior * PRIOR_DAYS) / (observed_days + PRIOR_DAYS)
+
+        days_since_fetched = None
+        priority = 1.0
+        if entry.last_fetched:
+            days_since_fetched = days_between(entry.last_fetched, now)
+            priority = 1 - math.exp(-rate * days_since_fetched)
+        candidates.append(RefreshCandidate(entry, key, source.cost(entry), rate, days_since_fetched, priority))
+    candidates.sort(key=lambda candidate: (candidate.priority / candidate.cost, candidate.rate), reverse=True)
+
+    plan = []
+    budget = source_budget(source.name) - spent_today(source.name, now)
+    for candidate in candidates:
+        # Allows for rounding in fractional costs.
+        if candidate.cost <= budget + 1e-9:
+            plan.append(candidate)
+            budget -= candidate.cost
+    return plan
+
+
+def record_refresh(source: RefreshSource, plan: list[RefreshCandidate], changed: dict, now: datetime.datetime):
+    refreshed = [candidate for candidate in plan if candidate.entry.get_id() in changed]
+    states = {
+        state.key: state
+        for state in RefreshState.select().where(
+            (RefreshState.source == source.name) &
+            (RefreshState.key << [candidate.key for candidate in refreshed]))
+    }
+
+    rows = []
+    for candidate in refreshed:
+        state = states.get(candidate.key)
+        rows.append((
+            source.name,
+            candidate.key,
+            (state.checks if state else 0) + 1,
+            (state.changes if state else 0) + int(changed[candidate.entry.get_id()]),
+            (state.observed_days if state else 0.0) + (candidate.days_since_fetched or 0.0),
+        ))
+
+    with db.atomic():
+        for start in range(0, len(rows), 1000):
+            (RefreshState
+             .insert_many(rows[start:start + 1000], [
+                 RefreshState.source,
+                 RefreshState.key,
+                 RefreshState.checks,
+                 RefreshState.changes,
+                 RefreshState.observed_days,
+             ])
+             .on_conflict_replace()
+             .execute())
+
+        # Requests are counted for every planned entry, as some are spent even when refreshing fails.
+        spent = spent_today(source.name, now) + sum(candidate.cost for candidate in plan)
+        RefreshSpend.replace(source=source.name, date=now.date().isoformat(), requests=spent).execute()
+
+
+def refresh_source(source: RefreshSource) -> int:
+    now = utcnow()
+    plan = plan_refresh(source, now)
+    cost = sum(candidate.cost for candidate in plan)
+    print(f"[refresh/{source.name}] {len(plan)} entries, {cost:g} of {source_budget(source.name):g} requests")
+    if REFRESH_DRY_RUN:
+        for candidate in plan:
+            days = "never" if candidate.days_since_fetched is None else f"{candidate.days_since_fetched:.1f}d"
+            print(f"[refresh/{source.name}/plan] {candidate.key} "
+                  f"priority={candidate.priority:.3f} rate={candidate.rate:.4f}/d fetched={days} "
+                  f"cost={candidate.cost:g}")
+        return 0
+
+    changed = source.refresh([candidate.entry for candidate in plan])
+    record_refresh(source, plan, changed, now)
+    print(f"[refresh/{source.name}] {sum(changed.values())} of {len(changed)} changed")
+    return len(changed)
+
+
+def main():
+    db.connect()
+    db.create_tables([RefreshState, RefreshSpend])
+
+    names = REFRESH_SOURCES.split(",") if REFRESH_SOURCES else [source.name for source in SOURCES]
+    for source in SOURCES:
+        if source.name not in names:
+            continue
+        source.database.connect(reuse_if_open=True)
+        with stage(source.name) as record:
+            record.rows = refresh_source(source)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,33 @@
+import datetime
+import hashlib
+import html
+import json
+import os
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 
 import requests
-from peewee import SqliteDatabase, Model, CharField, BlobField, IntegerField, ForeignKeyField
+from peewee import SqliteDatabase, Model, CharField, BlobField, IntegerField, ForeignKeyField, BooleanField, chunked, \
+    fn
 from playhouse.sqlite_ext import JSONField
-from requests.adapters import HTTPAdapter
-from urllib3 import Retry
 
 from .date_time_utc_field import DateTimeUTCField
-from .utility import HEADERS, tracing_response_hook, utcnow
+from .http_cache import fetch_page, save_page
+from .http_client import HttpClient, HostPolicy
+from .utility import utcnow, select_without_thumbnail
 
-requests = requests.Session()
-retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429])
-requests.mount("https://", HTTPAdapter(max_retries=retries))
-requests.hooks["response"].append(tracing_response_hook)
+# Pools are synced from the most recently updated down to the last pool seen by
+# the previous sync. Set `DB_FULL_SYNC=1` to walk every pool and refetch every
+# post, such as to pick up tag changes on posts of unchanged pools.
+DB_FULL_SYNC = os.environ.get("DB_FULL_SYNC") == "1"
+
+# Post chunks of one pool are fetched by this many threads at once.
+DB_CONCURRENCY = int(os.environ.get("DB_CONCURRENCY") or 4)
+
+client = HttpClient({
+    "danbooru.donmai.us": HostPolicy(connections=DB_CONCURRENCY),
+})
 db = SqliteDatabase("data/db.db")
 
 
@@ -39,19 +54,52 @@ class DBWikiPage(BaseModel):
     data = JSONField()
 
 
-class DBComments(BaseModel):
+class DBComment(BaseModel):
+    id = IntegerField(primary_key=True)
+    post_id = IntegerField(index=True)
+    is_deleted = BooleanField()
+
+
+# Posts whose comments have been requested in full.
+class DBCommentedPost(BaseModel):
+    post_id = IntegerField(primary_key=True)
+
+
+class DBCommentCount(BaseModel):
     pool = ForeignKeyField(DBEntry, unique=True)
-    comments = JSONField()
+    count = IntegerField()
 
 
+# Keyed by a digest of the renderer and the description it was rendered from.
 class DBPoolDescription(BaseModel):
     pool = ForeignKeyField(DBEntry, unique=True)
+    digest = CharField()
     html = CharField()
 
 
+# Progress of incremental syncs, such as the newest `updated_at` of synced pools.
+class DBSyncState(BaseModel):
+    name = CharField(primary_key=True)
+    value = CharField()
+
+
+def sync_state(name: str) -> Optional[str]:
+    state = DBSyncState.get_or_none(DBSyncState.name == name)
+    return state.value if state else None
+
+
+def set_sync_state(name: str, value: str):
+    DBSyncState.replace(name=name, value=value).execute()
+
+
+# Danbooru reports times in its local offset, which changes with daylight saving.
+def db_time(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value).astimezone(datetime.timezone.utc)
+
+
 def filter_db_entries():
     entries = []
-    for entry in DBEntry.select().order_by(DBEntry.pool_id):
+    for entry in select_without_thumbnail(DBEntry).order_by(DBEntry.pool_id):
         explicit_count = 0
         questionable_count = 0
         for post in entry.posts:
@@ -98,55 +146,86 @@ def db_pixiv_id(entry: DBEntry) -> int | None:
         return cover_post["pixiv_id"]
 
 
-# TODO: Include 東方 as query.
-def all_pools():
-    page = 1
-    while True:
-        result = requests.get(
-            "https://danbooru.donmai.us/pools.json",
-            headers=HEADERS,
-            params={
-                "page": page,
-                "search[category]": "series",
-                "search[is_deleted]": "false",
-                "search[name_contains]": "Touhou",
-            }
-        ).json()
+POOLS_URL = "https://danbooru.donmai.us/pools.json"
 
-        if not result:
-            return
 
+# TODO: Include 東方 as query.
+def pools_params(page: int) -> dict:
+    return {
+        "page": page,
+        "search[category]": "series",
+        "search[is_deleted]": "false",
+        "search[name_contains]": "Touhou",
+        "search[order]": "updated_at",
+    }
+
+
+# Most recently updated first, continuing from the pools of the first page.
+def all_pools(first_page: list[dict]):
+    result = first_page
+    page = 1
+    while result:
         yield from result
         page += 1
+        result = client.get(POOLS_URL, params=pools_params(page)).json()
 
 
+# Posts are returned in pool order.
 def gather_posts(post_ids: list[int]):
-    posts = []
     limit = 200
-    for start in range(0, len(post_ids), limit):
+
+    def gather_chunk(start: int) -> list[dict]:
         print(f"[post/chunk] {start} / {len(post_ids)}")
         ids = post_ids[start:start + limit]
-        posts += requests.get(
+        return client.get(
             f"https://danbooru.donmai.us/posts.json",
-            headers=HEADERS,
             params={
                 "tags": f"id:{','.join(map(str, ids))}",
                 "limit": limit,
             },
         ).json()
 
-    posts.sort(key=lambda p: post_ids.index(p["id"]))
+    posts = []
+    with ThreadPoolExecutor(DB_CONCURRENCY) as executor:
+        for chunk in executor.map(gather_chunk, range(0, len(post_ids), limit)):
+            posts += chunk
+
+    # Repeated posts are placed at their first position.
+    positions = {}
+    for position, post_id in enumerate(post_ids):
+        positions.setdefault(post_id, position)
+    posts.sort(key=lambda p: positions[p["id"]])
     return posts
 
 
 def scrape_pools():
-    for data in all_pools():
+    high_water_mark = None if DB_FULL_SYNC else sync_state("pools")
+    newest = high_water_mark
+
+    # No pool has been updated since the last sync if the first page is unchanged.
+    first_page = fetch_page(client, POOLS_URL, params=pools_params(1), conditional=bool(high_water_mark))
+    if not first_page.changed:
+        print("[pool/unchanged]")
+        return
+
+    for data in all_pools(json.loads(first_page.content)):
         pool_id = data["id"]
+        updated_at = db_time(data["updated_at"]).isoformat(timespec="microseconds")
+        if high_water_mark and updated_at < high_water_mark:
+            print(f"[pool/caught-up] {pool_id}")
+            break
+        newest = max(newest or updated_at, updated_at)
+
         if not data["post_ids"]:
             continue
 
+        # Posts are refetched only when the pool has changed, unless syncing in full.
+        existing = select_without_thumbnail(DBEntry).where(DBEntry.pool_id == pool_id).get_or_none()
+        if existing and not DB_FULL_SYNC and existing.data == data:
+            print(f"[pool/skip] {pool_id}")
+            continue
+
         posts = gather_posts(data["post_ids"])
-        existing = DBEntry.get_or_none(pool_id=pool_id)
         if existing:
             if existing.data == data and existing.posts == posts:
                 print(f"[pool/skip] {pool_id}")
@@ -168,7 +247,7 @@ def scrape_pools():
 
         fallback_url = posts[0]["preview_file_url"]
         thumbnail_url = media_urls.get("360x360", fallback_url)
-        thumbnail = requests.get(thumbnail_url, headers=HEADERS).content
+        thumbnail = client.get(thumbnail_url).content
 
         DBEntry.create(
             pool_id=pool_id,
@@ -178,6 +257,34 @@ def scrape_pools():
             last_fetched=utcnow(),
         )
 
+    # Recorded only once every updated pool has been synced.
+    if newest:
+        set_sync_state("pools", newest)
+    save_page(first_page)
+
+
+# Posts change without their pool being updated, such as when they are retagged.
+def refresh_pools(entries: list[DBEntry]) -> dict[int, bool]:
+    changed = {}
+    for entry in entries:
+        try:
+            posts = gather_posts(entry.data["post_ids"])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as error:
+            print(f"[refresh/fail] {entry.pool_id} {error}")
+            posts = None
+
+        if not posts:
+            if posts is not None:
+                print(f"[refresh/empty] {entry.pool_id}")
+            DBEntry.update(last_fetched=utcnow()).where(DBEntry.pool_id == entry.pool_id).execute()
+            changed[entry.pool_id] = False
+            continue
+
+        changed[entry.pool_id] = posts != entry.posts
+        print(f"[refresh/{'update' if changed[entry.pool_id] else 'same'}] {entry.pool_id}")
+        DBEntry.update(posts=posts, last_fetched=utcnow()).where(DBEntry.pool_id == entry.pool_id).execute()
+    return changed
+
 
 def pool_artists(entry: DBEntry) -> set[str]:
     artists = []
@@ -201,9 +308,8 @@ def scrape_artists():
             continue
 
         print(f"[artist/new] {artist}")
-        results = requests.get(
+        results = client.get(
             f"https://danbooru.donmai.us/artists.json",
-            headers=HEADERS,
             params={
                 "search[name]": artist,
             }
@@ -216,44 +322,90 @@ def scrape_artists():
             )
 
 
+# Comments of posts that were already synced are requested only if updated since
+# the previous sync, less this margin for differences between clocks.
+COMMENT_SYNC_OVERLAP = datetime.timedelta(hours=1)
+
+
 # FIXME: Handle request errors gracefully.
-def gather_comments(post_ids: list[int], batch_size: int = 200):
-    comments = []
+def gather_comments(post_ids: list[int], updated_since: Optional[str] = None) -> list[dict]:
+    batch_size = 500
     response_limit = 1000
-    for start in range(0, len(post_ids), batch_size):
+
+    def gather_batch(start: int) -> list[dict]:
         print(f"[comments/chunk] {start} / {len(post_ids)}")
-        ids = post_ids[start:start + batch_size]
-        response = requests.get(
-            f"https://danbooru.donmai.us/comments.json",
-            headers=HEADERS,
-            params={
-                "search[post_id]": ",".join(map(str, ids)),
-                "limit": response_limit,
-            },
-        ).json()
+        params = {
+            "search[post_id]": ",".join(map(str, post_ids[start:start + batch_size])),
+            "limit": response_limit,
+        }
+        if updated_since:
+            params["search[updated_at]"] = f">{updated_since}"
+
+        # Comments are listed newest first, so further pages are requested below the lowest id.
+        comments = []
+        while True:
+            response = client.get(
+                f"https://danbooru.donmai.us/comments.json",
+                params=params,
+            ).json()
+            comments += response
+            if len(response) < response_limit:
+                return comments
+            params["page"] = f"b{min(comment['id'] for comment in response)}"
 
-        # Retry with lower batch size if limit reached.
-        if len(response) == response_limit:
-            new_batch_size = batch_size // 2
-            return gather_comments(post_ids, batch_size=new_batch_size)
-        comments += response
+    comments = []
+    with ThreadPoolExecutor(DB_CONCURRENCY) as executor:
+        for batch in executor.map(gather_batch, range(0, len(post_ids), batch_size)):
+            comments += batch
     return comments
 
 
+# Only comment counts are used, so comments are kept as `(id, post_id, is_deleted)`.
+# Posts are requested in full when they are first seen, and afterwards only for
+# comments updated since the previous sync.
+# Every comment listed is counted, including deleted comments, as the count always has been.
 def scrape_comments():
-    for entry in DBEntry.select():
-        print(f"[comments/pool] {entry.pool_id}")
-        ids = [post["id"] for post in entry.posts]
-        comments = gather_comments(ids)
-
-        (DBComments.delete()
-         .where(DBComments.pool == entry)
-         .execute())
-
-        DBComments.create(
-            pool=entry,
-            comments=comments,
-        )
+    started = utcnow()
+    synced_at = sync_state("comments")
+    entries = list(select_without_thumbnail(DBEntry))
+    post_ids = sorted({post["id"] for entry in entries for post in entry.posts})
+
+    synced = set()
+    if synced_at:
+        synced = {post_id for post_id, in DBCommentedPost.select().tuples()}
+    new_post_ids = [post_id for post_id in post_ids if post_id not in synced]
+    synced_post_ids = [post_id for post_id in post_ids if post_id in synced]
+
+    print(f"[comments/new] {len(new_post_ids)} posts")
+    comments = gather_comments(new_post_ids)
+    if synced_post_ids:
+        updated_since = datetime.datetime.fromisoformat(synced_at) - COMMENT_SYNC_OVERLAP
+        print(f"[comments/updated] {len(synced_post_ids)} posts since {updated_since.isoformat()}")
+        comments += gather_comments(synced_post_ids, updated_since.isoformat())
+
+    with db.atomic():
+        rows = [(comment["id"], comment["post_id"], comment["is_deleted"]) for comment in comments]
+        for batch in chunked(rows, 1000):
+            (DBComment
+             .insert_many(batch, [DBComment.id, DBComment.post_id, DBComment.is_deleted])
+             .on_conflict_replace()
+             .execute())
+        for batch in chunked([(post_id,) for post_id in new_post_ids], 1000):
+            DBCommentedPost.insert_many(batch, [DBCommentedPost.post_id]).on_conflict_ignore().execute()
+
+        post_counts = dict(DBComment
+                           .select(DBComment.post_id, fn.COUNT(DBComment.id))
+                           .group_by(DBComment.post_id)
+                           .tuples())
+        counts = [
+            (entry.pool_id, sum(post_counts.get(post_id, 0) for post_id in {post["id"] for post in entry.posts}))
+            for entry in entries
+        ]
+        DBCommentCount.delete().execute()
+        for batch in chunked(counts, 1000):
+            DBCommentCount.insert_many(batch, [DBCommentCount.pool, DBCommentCount.count]).execute()
+        set_sync_state("comments", started.isoformat())
+    print(f"[comments/synced] {len(comments)} comments")
 
 
 def significant_characters() -> Counter[str]:
@@ -280,10 +432,9 @@ def scrape_wiki_pages():
             continue
 
         print(f"[wiki] {character}")
-        results = requests.get(
+        results = client.get(
             "https://danbooru.donmai.us/wiki_pages.json",
             params={"search[title_normalize]": character},
-            headers=HEADERS,
         ).json()
 
         if results:
@@ -293,41 +444,96 @@ def scrape_wiki_pages():
             )
 
 
-def render_pool_descriptions():
+# Renders DText descriptions to HTML, in order.
+# Pools keep the HTML of the renderer they were last rendered with.
+def dtext_renderer(strings: list[str]) -> list[str]:
+    return client.post(
+        f"https://dtext.nsk.sh/dtext-parse",
+        json=strings,
+    ).json()
+
+
+# Stand-in for `dtext_renderer` that escapes each paragraph as plain text,
+# for runs without access to the renderer such as the synthetic corpus.
+def plain_text_renderer(strings: list[str]) -> list[str]:
+    return ["".join(f"<p>{html.escape(paragraph.strip())}</p>"
+                    for paragraph in string.split("\n\n")
+                    if paragraph.strip())
+            for string in strings]
+
+
+DESCRIPTION_RENDERERS: dict[str, Callable[[list[str]], list[str]]] = {
+    "dtext": dtext_renderer,
+    "plain": plain_text_renderer,
+}
+DB_DESCRIPTION_RENDERER = os.environ.get("DB_DESCRIPTION_RENDERER") or "dtext"
+
+
+def description_digest(renderer: str, description: str) -> str:
+    digest = hashlib.blake2b(renderer.encode(), digest_size=16)
+    digest.update(description.encode())
+    return digest.hexdigest()
+
+
+# Only descriptions that are new or changed since they were last rendered are sent.
+def render_pool_descriptions(renderer: str = DB_DESCRIPTION_RENDERER):
     batch_size = 1000
-    entries = list(DBEntry.select())
-    for start in range(0, len(entries), batch_size):
+    digests = dict(DBPoolDescription.select(DBPoolDescription.pool, DBPoolDescription.digest).tuples())
+    changed = []
+    for pool_id, data in DBEntry.select(DBEntry.pool_id, DBEntry.data).tuples():
+        digest = description_digest(renderer, data["description"])
+        if digests.get(pool_id) != digest:
+            changed.append((pool_id, digest, data["description"]))
+
+    print(f"[descriptions] {len(changed)} changed")
+    for start in range(0, len(changed), batch_size):
         print(f"[descriptions] {start}")
-        batch = entries[start:start + batch_size]
-        strings = [entry.data["description"] for entry in batch]
+        batch = changed[start:start + batch_size]
 
-        results = requests.post(
-            f"https://dtext.nsk.sh/dtext-parse",
-            headers=HEADERS,
-            json=strings,
-        ).json()
+        # Empty descriptions are not sent.
+        strings = [description for _, _, description in batch if description.strip()]
+        results = iter(DESCRIPTION_RENDERERS[renderer](strings))
+        rows = [(pool_id, digest, next(results) if description.strip() else "")
+                for pool_id, digest, description in batch]
 
-        for entry, html in zip(batch, results):
-            (DBPoolDescription.delete()
-             .where(DBPoolDescription.pool == entry)
-             .execute())
+        (DBPoolDescription
+         .insert_many(rows, [DBPoolDescription.pool, DBPoolDescription.digest, DBPoolDescription.html])
+         .on_conflict_replace()
+         .execute())
 
-            DBPoolDescription.create(
-                pool=entry,
-                html=html,
-            )
 
+def create_tables():
+    # Descriptions from older layouts have no digests, so they are rendered again.
+    table = DBPoolDescription._meta.table_name
+    if db.table_exists(table):
+        columns = {column.name for column in db.get_columns(table)}
+        if columns != set(DBPoolDescription._meta.columns.keys()):
+            db.drop_tables([DBPoolDescription])
 
-def main():
-    db.connect()
     db.create_tables([
         DBEntry,
         DBArtist,
-        DBComments,
+        DBComment,
+        DBCommentedPost,
+        DBCommentCount,
         DBWikiPage,
         DBPoolDescription,
+        DBSyncState,
     ])
 
+    # Comments from the older layout are replaced by `DBCommentCount`. Their counts are kept
+    # until the first sync, which requests every post in full as it has no sync state yet.
+    if db.table_exists("dbcomments"):
+        with db.atomic():
+            db.execute_sql("INSERT OR IGNORE INTO dbcommentcount (pool_id, count) "
+                           "SELECT pool_id, json_array_length(comments) FROM dbcomments")
+            db.execute_sql("DROP TABLE dbcomments")
+
+
+def main():
+    db.connect()
+    create_tables()
+
     scrape_pools()
     scrape_artists()
     scrape_comments()
@@ -1,3 +1,5 @@
+import datetime
+import json
 from typing import Optional
 
 import PIL
@@ -5,15 +7,13 @@ import requests
 from bs4 import BeautifulSoup
 from peewee import SqliteDatabase, Model, BlobField, CharField, IntegerField, ForeignKeyField
 from playhouse.sqlite_ext import JSONField
-from requests.adapters import Retry, HTTPAdapter
 
 from .date_time_utc_field import DateTimeUTCField
-from .utility import HEADERS, create_thumbnail, tracing_response_hook, utcnow
+from .http_cache import fetch_page, save_page
+from .http_client import HttpClient
+from .utility import create_thumbnail, utcnow, select_without_thumbnail
 
-s = requests.Session()
-retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
-s.mount("https://", HTTPAdapter(max_retries=retries))
-s.hooks["response"].append(tracing_response_hook)
+client = HttpClient()
 db = SqliteDatabase("data/ds.db")
 
 
@@ -43,7 +43,7 @@ class DSEntryTopicSlug(BaseModel):
 
 def filter_ds_entries():
     entries = []
-    for entry in DSEntry.select():
+    for entry in select_without_thumbnail(DSEntry):
         def is_nsfw():
             for tag in entry.data["tags"]:
                 if tag["type"] == "General" and tag["name"] == "NSFW":
@@ -101,11 +101,18 @@ def ds_entry_comments(entry: DSEntry) -> Optional[int]:
         return topic.comments
 
 
+# Pages that are unchanged since they were last processed in full are skipped.
+# Pages with a chapter whose cover could not be read are processed again on the next run.
 def scrape_entries():
     url = "https://dynasty-scans.com/doujins/touhou_project.json"
-    page_count = int(s.get(url, headers=HEADERS).json()["total_pages"])
+    page_count = int(client.get(url).json()["total_pages"])
     for page in range(1, page_count + 1):
-        chapter_index = s.get(url, params={"page": page}, headers=HEADERS).json()
+        listing = fetch_page(client, url, params={"page": page})
+        if not listing.changed:
+            continue
+
+        chapter_index = json.loads(listing.content)
+        complete = True
         for chapter in chapter_index["taggings"]:
             slug = chapter["permalink"]
             entry = DSEntry.get_or_none(slug=slug)
@@ -120,12 +127,14 @@ def scrape_entries():
                 print(f"[chapter/new] {slug}")
 
             chapter_url = f"https://dynasty-scans.com/chapters/{slug}.json"
-            chapter_data = s.get(chapter_url, headers=HEADERS).json()
-            cover = s.get("https://dynasty-scans.com" + chapter_data["pages"][0]["url"]).content
+            chapter_data = client.get(chapter_url).json()
+            cover = client.get("https://dynasty-scans.com" + chapter_data["pages"][0]["url"]).content
 
             try:
                 thumbnail_data = create_thumbnail(cover)
             except PIL.UnidentifiedImageError:
+                print(f"[chapter/fail] {slug}")
+                complete = False
                 continue
 
             DSEntry.create(
@@ -134,15 +143,48 @@ def scrape_entries():
                 thumbnail=thumbnail_data,
                 last_fetched=utcnow(),
             )
+        if complete:
+            save_page(listing)
+
+
+def ds_published(entry: DSEntry) -> Optional[datetime.datetime]:
+    if entry.data.get("released_on"):
+        return datetime.datetime.fromisoformat(entry.data["released_on"]).replace(tzinfo=datetime.timezone.utc)
+
+
+# Chapters that cannot be refetched, such as deleted chapters, keep the stored data.
+def refresh_chapters(entries: list[DSEntry]) -> dict[str, bool]:
+    changed = {}
+    for entry in entries:
+        try:
+            response = client.get(f"https://dynasty-scans.com/chapters/{entry.slug}.json")
+            response.raise_for_status()
+            chapter_data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as error:
+            print(f"[refresh/fail] {entry.slug} {error}")
+            DSEntry.update(last_fetched=utcnow()).where(DSEntry.slug == entry.slug).execute()
+            changed[entry.slug] = False
+            continue
 
+        changed[entry.slug] = chapter_data != entry.data
+        print(f"[refresh/{'update' if changed[entry.slug] else 'same'}] {entry.slug}")
+        DSEntry.update(data=chapter_data, last_fetched=utcnow()).where(DSEntry.slug == entry.slug).execute()
+    return changed
 
+
+# The empty page that ends the forum is never saved,
+# so unchanged pages are known to have topics.
 def scrape_topics():
     page = 1
     url = "https://dynasty-scans.com/forum?page=2"
     while True:
         print(f"[topics/page] {page}")
-        response = s.get(url, headers=HEADERS, params={"page": page})
-        html = BeautifulSoup(response.content, features="html.parser")
+        listing = fetch_page(client, url, params={"page": page})
+        if not listing.changed:
+            page += 1
+            continue
+
+        html = BeautifulSoup(listing.content, features="html.parser")
         topics = html.find_all(attrs={"class": "forum_topic"})
 
         for topic in topics:
@@ -170,6 +212,7 @@ def scrape_topics():
 
         if not topics:
             break
+        save_page(listing)
         page += 1
 
 
@@ -181,7 +224,7 @@ def scrape_entry_topic_slugs():
 
         print(f"[topic/slug] {entry.slug}")
         url = f"https://dynasty-scans.com/chapters/{entry.slug}"
-        response = s.get(url, headers=HEADERS).content
+        response = client.get(url).content
 
         html = BeautifulSoup(response, features="html.parser")
         icon = html.find("i", attrs={"class": "icon-comment"})
@@ -1,16 +1,29 @@
-import time
+import datetime
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 from peewee import SqliteDatabase, Model, IntegerField, BlobField
 from playhouse.sqlite_ext import JSONField
 from bs4 import BeautifulSoup
 
 from .date_time_utc_field import DateTimeUTCField
-from .utility import HEADERS, tracing_response_hook, utcnow
-
-REFRESH_COUNT = 100
-requests = requests.Session()
-requests.hooks["response"].append(tracing_response_hook)
+from .http_client import HttpClient, HostPolicy
+from .utility import utcnow, select_without_thumbnail
+
+API_URL = "https://api.e-hentai.org/api.php"
+
+# Minimum seconds between requests to each host.
+EH_HOST_INTERVALS = {
+    "e-hentai.org": 10.0,
+    "api.e-hentai.org": 1.0,
+}
+EH_DEFAULT_INTERVAL = 1.0
+
+client = HttpClient(
+    {host: HostPolicy(rate=1 / interval) for host, interval in EH_HOST_INTERVALS.items()},
+    default=HostPolicy(rate=1 / EH_DEFAULT_INTERVAL),
+)
 db = SqliteDatabase("data/eh.db")
 
 
@@ -27,7 +40,7 @@ class EHEntry(BaseModel):
 
 
 def filter_eh_entries():
-    for entry in EHEntry.select().order_by(EHEntry.gid):
+    for entry in select_without_thumbnail(EHEntry).order_by(EHEntry.gid):
         # Ignore image sets.
         if "other:non-h imageset" in entry.data["tags"]:
             continue
@@ -58,11 +71,8 @@ def gallery_metadata(gidlist: list) -> list[dict]:
     # The gdata API accepts at most 25 gids per request.
     metadata = []
     for start in range(0, len(gidlist), 25):
-        if start:
-            time.sleep(1)
-        metadata += requests.post(
-            "https://api.e-hentai.org/api.php",
-            headers=HEADERS,
+        metadata += client.post(
+            API_URL,
             json={
                 "method": "gdata",
                 "gidlist": gidlist[start:start + 25],
@@ -72,53 +82,103 @@ def gallery_metadata(gidlist: list) -> list[dict]:
     return metadata
 
 
-def scrape_galleries():
-    latest = list(EHEntry.select().order_by(EHEntry.gid.desc()).limit(1))
-    start_gid = latest[0].gid if latest else 1
-    search_url = f"https://e-hentai.org/?f_search=parody:%22touhou+project%24%22&f_cats=767&prev={start_gid}"
-    while True:
-        print(f"[request] {search_url}")
-        html = BeautifulSoup(requests.get(search_url, headers=HEADERS).content, features="html.parser")
-
-        galleries = []
-        for link_element in html.find_all("a"):
-            link = link_element.attrs["href"]
-            if link.startswith("https://e-hentai.org/g/"):
-                [gid, token, _end] = link.split("/")[-3:]
-                galleries.append([int(gid), token])
-
-        if not galleries:
-            break
-
-        for gallery in gallery_metadata(galleries):
-            gid = gallery["gid"]
-            if EHEntry.select().where(EHEntry.gid == gid):
-                print(f"[gallery/skip] {gid}")
-                continue
-
-            print(f"[gallery/new] {gid}")
+# Stages run in their own threads and pass items downstream through queues,
+# followed by `None` once they are done or the pipeline has stopped.
+def search_stage(start_gid: int, pages: queue.Queue, stopped: threading.Event):
+    try:
+        search_url = f"https://e-hentai.org/?f_search=parody:%22touhou+project%24%22&f_cats=767&prev={start_gid}"
+        while search_url and not stopped.is_set():
+            print(f"[request] {search_url}")
+            html = BeautifulSoup(client.get(search_url).content, features="html.parser")
+
+            galleries = []
+            for link_element in html.find_all("a"):
+                link = link_element.attrs["href"]
+                if link.startswith("https://e-hentai.org/g/"):
+                    [gid, token, _end] = link.split("/")[-3:]
+                    galleries.append([int(gid), token])
+
+            if not galleries:
+                break
+            pages.put(galleries)
+
+            previous_url_element = html.find("a", attrs={"id": "uprev"})
+            if previous_url_element is None:
+                break
+            search_url = previous_url_element.attrs.get("href", None)
+    finally:
+        pages.put(None)
+
+
+# Galleries that are already stored are skipped before their metadata is requested.
+def metadata_stage(pages: queue.Queue, galleries: queue.Queue, stopped: threading.Event):
+    try:
+        with db.connection_context():
+            while (page := pages.get()) is not None and not stopped.is_set():
+                gids = [gid for gid, _token in page]
+                existing = {gid for gid, in EHEntry.select(EHEntry.gid).where(EHEntry.gid << gids).tuples()}
+                for gid in existing:
+                    print(f"[gallery/skip] {gid}")
+
+                gidlist = [[gid, token] for gid, token in page if gid not in existing]
+                if gidlist:
+                    for gallery in gallery_metadata(gidlist):
+                        galleries.put(gallery)
+    finally:
+        galleries.put(None)
+
+
+def thumbnail_stage(galleries: queue.Queue, thumbnails: queue.Queue, stopped: threading.Event):
+    try:
+        while (gallery := galleries.get()) is not None and not stopped.is_set():
+            print(f"[gallery/new] {gallery['gid']}")
             thumbnail_url = gallery["thumb"].replace("l.jpg", "300.jpg")
-            thumbnail = requests.get(thumbnail_url, headers=HEADERS).content
-            EHEntry.create(gid=gid, data=gallery, thumbnail=thumbnail, last_fetched=utcnow())
-            time.sleep(1)
+            thumbnails.put((gallery, client.get(thumbnail_url).content))
+    finally:
+        thumbnails.put(None)
 
-        previous_url_element = html.find("a", attrs={"id": "uprev"})
-        if previous_url_element is None:
-            break
-
-        # Delay for 10 seconds.
-        search_url = previous_url_element.attrs.get("href", None)
-        time.sleep(10)
 
+# Search pages, metadata and thumbnails are requested concurrently,
+# as each host is only limited by its own interval. Rows are written by this thread.
+def scrape_galleries():
+    latest = list(EHEntry.select().order_by(EHEntry.gid.desc()).limit(1))
+    start_gid = latest[0].gid if latest else 1
 
-def refresh_entries():
+    pages, galleries, thumbnails = queue.Queue(), queue.Queue(), queue.Queue()
+    stopped = threading.Event()
+    with ThreadPoolExecutor(3) as executor:
+        stages = [
+            executor.submit(search_stage, start_gid, pages, stopped),
+            executor.submit(metadata_stage, pages, galleries, stopped),
+            executor.submit(thumbnail_stage, galleries, thumbnails, stopped),
+        ]
+        try:
+            while (item := thumbnails.get()) is not None:
+                gallery, thumbnail = item
+                EHEntry.create(gid=gallery["gid"], data=gallery, thumbnail=thumbnail, last_fetched=utcnow())
+        finally:
+            stopped.set()
+
+    # Raises the first error of any stage.
+    for stage in stages:
+        stage.result()
+
+
+def eh_published(entry: EHEntry) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(int(entry.data["posted"]), datetime.timezone.utc)
+
+
+# Galleries without a token cannot be refetched.
+# Galleries that are gone keep the stored data.
+def refresh_galleries(entries: list[EHEntry]) -> dict[int, bool]:
+    changed = {}
     gidlist = []
     indexed = {}
-    for entry in EHEntry.select().order_by(EHEntry.last_fetched.asc()).limit(REFRESH_COUNT):
+    for entry in entries:
         token = entry.data.get("token")
         if token is None:
-            entry.last_fetched = utcnow()
-            entry.save()
+            EHEntry.update(last_fetched=utcnow()).where(EHEntry.gid == entry.gid).execute()
+            changed[entry.gid] = False
             print(f"[refresh/skip] {entry.gid}")
             continue
         gidlist.append([entry.gid, token])
@@ -129,25 +189,26 @@ def refresh_entries():
     except Exception as error:
         # Leave rows untouched so they retry next run.
         print(f"[refresh/fail] {error}")
-        return
+        return changed
 
     for gallery in metadata:
         entry = indexed[gallery["gid"]]
+        changed[entry.gid] = False
         if "error" in gallery:
-            # The gallery is gone: keep the stored data, only rotate it out.
             print(f"[refresh/gone] {entry.gid}")
-        else:
-            entry.data = gallery
-            print(f"[refresh/update] {entry.gid}")
-        entry.last_fetched = utcnow()
-        entry.save()
+            EHEntry.update(last_fetched=utcnow()).where(EHEntry.gid == entry.gid).execute()
+            continue
+
+        changed[entry.gid] = gallery != entry.data
+        print(f"[refresh/{'update' if changed[entry.gid] else 'same'}] {entry.gid}")
+        EHEntry.update(data=gallery, last_fetched=utcnow()).where(EHEntry.gid == entry.gid).execute()
+    return changed
 
 
 def main():
     db.connect()
     db.create_tables([EHEntry])
     scrape_galleries()
-    refresh_entries()
 
 
 if __name__ == '__main__':
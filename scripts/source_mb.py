@@ -1,18 +1,16 @@
 import dataclasses
-import time
 from datetime import datetime
 
 import requests
 from bs4 import BeautifulSoup
 from lxml.cssselect import CSSSelector
-from peewee import Model, SqliteDatabase, IntegerField, CharField, BlobField
-from requests.adapters import HTTPAdapter
-from urllib3.util import create_urllib3_context
+from peewee import Model, SqliteDatabase, IntegerField, CharField, BlobField, fn
 import urllib.parse
 from lxml import etree
 
 from .date_time_utc_field import DateTimeUTCField
-from .utility import strain_html, get_with_proxy, HEADERS, utcnow, OutOfCreditsError
+from .http_client import HttpClient, HostPolicy, get_with_proxy
+from .utility import strain_html, utcnow, OutOfCreditsError, select_without_thumbnail
 
 # Outdated cipher is being used.
 CIPHER = "ALL:@SECLEVEL=1"
@@ -21,13 +19,6 @@ CONNECTION_FAILURE_LIMIT = 10
 db = SqliteDatabase("data/mb.db")
 
 
-class CustomCipherAdapter(HTTPAdapter):
-    def init_poolmanager(self, *args, **kwargs):
-        context = create_urllib3_context(ciphers=CIPHER)
-        kwargs['ssl_context'] = context
-        return super(CustomCipherAdapter, self).init_poolmanager(*args, **kwargs)
-
-
 class BaseModel(Model):
     class Meta:
         database = db
@@ -40,10 +31,12 @@ class MBEntry(BaseModel):
     last_fetched = DateTimeUTCField(null=True)
 
 
-session = requests.Session()
-session.mount("https://", CustomCipherAdapter())
-# The thumbnail CDN rejects the default python user agent.
-session.headers.update(HEADERS)
+# The thumbnail CDN rejects the default python user agent, which the client replaces.
+client = HttpClient(default=HostPolicy(
+    ciphers=CIPHER,
+    retries=CONNECTION_FAILURE_LIMIT,
+    backoff=CONNECTION_FAILURE_DELAY_SECONDS,
+))
 
 
 @dataclasses.dataclass()
@@ -56,90 +49,79 @@ class MBDataEntry:
     characters: list[str]
     circles: list[str]
     authors: list[str]
-    thumbnail: bytes
-
-
-def mb_entries() -> list[MBDataEntry]:
-    entries = []
-    select_comments = CSSSelector(".item-detail.mt24")
-    select_table_headers = CSSSelector("th")
-    select_links = CSSSelector("a")
-    for entry in MBEntry.select():
-        page = strain_html(entry.data, "div", '<div class="item-page">')
-        tree = etree.HTML(page)
-        if not entry.thumbnail:
+    thumbnail: bytes | None
+
+
+SELECT_COMMENTS = CSSSelector(".item-detail.mt24")
+SELECT_TABLE_HEADERS = CSSSelector("th")
+SELECT_LINKS = CSSSelector("a")
+
+
+def parse_mb_entry(entry: MBEntry) -> MBDataEntry:
+    page = strain_html(entry.data, "div", '<div class="item-page">')
+    tree = etree.HTML(page)
+
+    table = {}
+    for header in SELECT_TABLE_HEADERS(tree):
+        table[header.text] = header.getnext().text.strip()
+
+    release_date = None
+    release_date_key = "発行日"
+    if release_date_key in table:
+        for format in ["%Y/%m/%d", "%d/%m/%Y"]:
+            try:
+                release_date = datetime.strptime(table[release_date_key], format)
+                break
+            except ValueError:
+                pass
+
+    pages = None
+    pages_key = "総ページ数・CG数・曲数"
+    if pages_key in table:
+        pages = int(table[pages_key])
+
+    comments = []
+    for comment in SELECT_COMMENTS(tree):
+        heading = comment.find("h3")
+        content = etree.tostring(heading.getnext(), method="html", encoding="unicode")
+        comments.append(f"<b>{heading.text}</b>\n{content}")
+
+    characters, authors, circles = [], [], []
+    for link in SELECT_LINKS(tree):
+        href = link.attrib.get("href", "")
+        text = link.text and link.text.strip()
+        if not text:
             continue
 
-        table = {}
-        for header in select_table_headers(tree):
-            table[header.text] = header.getnext().text.strip()
-
-        release_date = None
-        release_date_key = "発行日"
-        if release_date_key in table:
-            for format in ["%Y/%m/%d", "%d/%m/%Y"]:
-                try:
-                    release_date = datetime.strptime(table[release_date_key], format)
-                    break
-                except ValueError:
-                    pass
-
-        pages = None
-        pages_key = "総ページ数・CG数・曲数"
-        if pages_key in table:
-            pages = int(table[pages_key])
-
-        comments = []
-        for comment in select_comments(tree):
-            heading = comment.find("h3")
-            content = etree.tostring(heading.getnext(), method="html", encoding="unicode")
-            comments.append(f"<b>{heading.text}</b>\n{content}")
-
-        characters, authors, circles = [], [], []
-        for link in select_links(tree):
-            href = link.attrib.get("href", "")
-            text = link.text and link.text.strip()
-            if not text:
-                continue
+        prefix = "https://www.melonbooks.co.jp/tags/index.php?chara="
+        if href.startswith(prefix):
+            characters.append(text.removeprefix("#"))
 
-            prefix = "https://www.melonbooks.co.jp/tags/index.php?chara="
-            if href.startswith(prefix):
-                characters.append(text.removeprefix("#"))
-
-            suffix = "&text_type=author"
-            if href.endswith(suffix):
-                authors.append(text)
-
-            prefix = "https://www.melonbooks.co.jp/circle/index.php?circle_id="
-            if href.startswith(prefix) and ("作品数" not in text):
-                circles.append(text)
-
-        entries.append(MBDataEntry(
-            id=entry.id,
-            title=tree.find(".//h1").text,
-            pages=pages,
-            release_date=release_date,
-            comments=("<br/>".join(comments)),
-            characters=characters,
-            circles=circles,
-            authors=authors,
-            thumbnail=entry.thumbnail,
-        ))
-    return entries
-
-
-def get(url, **kwargs):
-    failures = 0
-    while True:
-        try:
-            return session.get(url, **kwargs)
-        except requests.exceptions.ConnectionError as e:
-            print(f"[url/retry] {url}")
-            time.sleep(CONNECTION_FAILURE_DELAY_SECONDS)
+        suffix = "&text_type=author"
+        if href.endswith(suffix):
+            authors.append(text)
+
+        prefix = "https://www.melonbooks.co.jp/circle/index.php?circle_id="
+        if href.startswith(prefix) and ("作品数" not in text):
+            circles.append(text)
 
-            failures += 1
-            if failures >= CONNECTION_FAILURE_LIMIT:
-                raise e
+    return MBDataEntry(
+        id=entry.id,
+        title=tree.find(".//h1").text,
+        pages=pages,
+        release_date=release_date,
+        comments=("<br/>".join(comments)),
+        characters=characters,
+        circles=circles,
+        authors=authors,
+        thumbnail=entry.thumbnail,
+    )
+
+
+# Thumbnails may be omitted and read later from `MBEntry`.
+def mb_entries(thumbnails: bool = True) -> list[MBDataEntry]:
+    query = MBEntry.select() if thumbnails else select_without_thumbnail(MBEntry)
+    return [parse_mb_entry(entry) for entry in query.where(fn.LENGTH(MBEntry.thumbnail) > 0)]
 
 
 def source_mb():
@@ -184,14 +166,9 @@ def source_mb():
             thumbnail_parsed = urllib.parse.urlparse(thumbnail_url)
             thumbnail_query = urllib.parse.parse_qs(thumbnail_parsed.query)
             if "image" in thumbnail_query:
-                thumbnail = get(thumbnail_url).content
+                thumbnail = client.get(thumbnail_url).content
 
-            data = get_with_proxy(
-                "https://www.melonbooks.co.jp/detail/detail.php",
-                proxy_country="JP",
-                retries=10,
-                params={"product_id": product_id}
-            ).content
+            data = mb_product_page(product_id)
 
             # Skip error pages such as delisted products.
             if b'<div class="item-page">' not in data:
@@ -210,6 +187,57 @@ def source_mb():
         page_number += 1
 
 
+def mb_product_page(product_id: int) -> bytes:
+    return get_with_proxy(
+        "https://www.melonbooks.co.jp/detail/detail.php",
+        proxy_country="JP",
+        retries=10,
+        params={"product_id": product_id}
+    ).content
+
+
+# Pages are compared by their parsed details, as the rest of the page changes on every request.
+# Pages that are no longer valid, such as delisted products, keep the stored page.
+# Products refreshed before credits ran out are still returned.
+def refresh_products(entries: list[MBEntry]) -> dict[int, bool]:
+    changed = {}
+    query = select_without_thumbnail(MBEntry).where(MBEntry.id << [entry.id for entry in entries])
+    for entry in query:
+        try:
+            data = mb_product_page(entry.id)
+        except OutOfCreditsError as e:
+            print(f"[credits/exhausted] {e}")
+            return changed
+        except (requests.exceptions.RequestException, ValueError) as error:
+            print(f"[refresh/fail] {entry.id} {error}")
+            MBEntry.update(last_fetched=utcnow()).where(MBEntry.id == entry.id).execute()
+            changed[entry.id] = False
+            continue
+
+        if b'<div class="item-page">' not in data:
+            print(f"[refresh/invalid] {entry.id}")
+            MBEntry.update(last_fetched=utcnow()).where(MBEntry.id == entry.id).execute()
+            changed[entry.id] = False
+            continue
+
+        try:
+            details = parse_mb_entry(MBEntry(id=entry.id, data=MBEntry.data.adapt(data)))
+        except (AttributeError, TypeError, ValueError) as error:
+            print(f"[refresh/invalid] {entry.id} {error}")
+            MBEntry.update(last_fetched=utcnow()).where(MBEntry.id == entry.id).execute()
+            changed[entry.id] = False
+            continue
+
+        # A stored page that can no longer be parsed is replaced.
+        try:
+            changed[entry.id] = details != parse_mb_entry(entry)
+        except (AttributeError, TypeError, ValueError):
+            changed[entry.id] = True
+        print(f"[refresh/{'update' if changed[entry.id] else 'same'}] {entry.id}")
+        MBEntry.update(data=data, last_fetched=utcnow()).where(MBEntry.id == entry.id).execute()
+    return changed
+
+
 def main():
     db.connect()
     db.create_tables([MBEntry])
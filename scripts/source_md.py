@@ -1,19 +1,50 @@
+import asyncio
+import contextlib
 import dataclasses
+import functools
+import os
 import re
-import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
 import PIL
 import mistletoe
 import requests
 from peewee import SqliteDatabase, Model, BlobField, CharField, ForeignKeyField
 from playhouse.sqlite_ext import JSONField
+from requests import Response
 
 from .date_time_utc_field import DateTimeUTCField
-from .utility import HEADERS, create_thumbnail, tracing_response_hook, utcnow
+from .http_client import HttpClient, HostPolicy
+from .utility import create_thumbnail, utcnow, select_without_thumbnail, read_thumbnail
 
 BASE_URL = "https://api.mangadex.org"
-requests = requests.Session()
-requests.hooks["response"].append(tracing_response_hook)
+
+# Requests are made from this many threads at once.
+# Set `MD_CONCURRENCY=1` to scrape sequentially instead.
+MD_CONCURRENCY = int(os.environ.get("MD_CONCURRENCY") or 8)
+
+# Requests per second allowed by MangaDex for the whole API and for each route.
+# Requests are spaced evenly rather than sent in bursts, which could cross the
+# fixed windows that MangaDex counts in. Each window is enforced through the
+# `X-RateLimit-*` headers of the responses.
+MD_RATE_LIMIT = 5.0
+MD_ROUTE_RATE_LIMITS = {
+    "at-home": 40 / 60,
+}
+
+# Requests that are rate limited wait for the window to reset, so they are retried for longer.
+client = HttpClient(
+    {
+        "api.mangadex.org": HostPolicy(
+            rate=MD_RATE_LIMIT,
+            routes=MD_ROUTE_RATE_LIMITS,
+            connections=MD_CONCURRENCY,
+            retries=10,
+        ),
+    },
+    default=HostPolicy(connections=MD_CONCURRENCY),
+)
 db = SqliteDatabase("data/md.db")
 
 
@@ -51,7 +82,7 @@ class MDEntry:
     date: str
     pages: int
     comments: int
-    thumbnail: bytes
+    thumbnail: bytes | None
 
 
 MD_LANGUAGE_MAP = {
@@ -123,9 +154,16 @@ def md_manga_comments(manga: MDManga) -> int:
     return (title_comments and title_comments["repliesCount"]) or 0
 
 
-def all_md_chapters() -> list[MDEntry]:
+def md_chapter_thumbnail(slug: str, manga: MDManga) -> bytes:
+    data = MDChapter.get_or_none(MDChapter.slug == slug)
+    return data.thumbnail if data else (manga.thumbnail or read_thumbnail(MDManga, manga.slug))
+
+
+# Thumbnails may be omitted and read later with `md_chapter_thumbnail`.
+def all_md_chapters(thumbnails: bool = True) -> list[MDEntry]:
     chapters = []
-    for manga in MDManga.select():
+    query = MDManga.select() if thumbnails else select_without_thumbnail(MDManga)
+    for manga in query:
         statistics = MDStatistics.get(manga=manga)
         for chapter in manga.chapters:
             def chapter_title():
@@ -142,10 +180,6 @@ def all_md_chapters() -> list[MDEntry]:
                 code = chapter["attributes"]["translatedLanguage"]
                 return md_language(code)
 
-            def chapter_thumbnail():
-                data = MDChapter.get_or_none(MDChapter.slug == chapter["id"])
-                return data.thumbnail if data else manga.thumbnail
-
             def chapter_comments():
                 comments = statistics.chapters[chapter["id"]]["comments"]
                 return comments and comments["repliesCount"]
@@ -159,20 +193,32 @@ def all_md_chapters() -> list[MDEntry]:
                 date=chapter["attributes"]["publishAt"],
                 pages=int(chapter["attributes"]["pages"]),
                 comments=chapter_comments(),
-                thumbnail=chapter_thumbnail(),
+                thumbnail=(md_chapter_thumbnail(chapter["id"], manga) if thumbnails else None),
             ))
     return chapters
 
 
+def manga_params(params):
+    return params + [
+        ("title", "Touhou"),
+        ("includes[]", "author"),
+        ("includes[]", "artist"),
+    ]
+
+
 def manga_request(params):
-    return request_with_retry(
-        f"{BASE_URL}/manga",
-        params=params + [
-            ("title", "Touhou"),
-            ("includes[]", "author"),
-            ("includes[]", "artist"),
-        ],
-    ).json()
+    return client.get(f"{BASE_URL}/manga", params=manga_params(params)).json()
+
+
+def md_cover_url(slug: str, covers: list[dict]) -> str:
+    def cover_sort_key(c):
+        volume = c["attributes"]["volume"]
+        date = c["attributes"]["createdAt"]
+        return volume or date
+
+    first_cover = sorted(covers, key=cover_sort_key)[0]
+    cover_file = first_cover["attributes"]["fileName"]
+    return f"https://uploads.mangadex.org/covers/{slug}/{cover_file}.256.jpg"
 
 
 def scrape_manga():
@@ -200,7 +246,7 @@ def scrape_manga():
             else:
                 print(f"[manga/new] {slug}")
 
-            covers = request_with_retry(
+            covers = client.get(
                 f"{BASE_URL}/cover",
                 params={
                     "limit": limit,
@@ -212,19 +258,11 @@ def scrape_manga():
                 print(f"[manga/uncovered] {slug}")
                 continue
 
-            def cover_sort_key(c):
-                volume = c["attributes"]["volume"]
-                date = c["attributes"]["createdAt"]
-                return volume or date
-
-            first_cover = sorted(covers, key=cover_sort_key)[0]
-            cover_file = first_cover["attributes"]["fileName"]
-            thumbnail = requests.get(
-                url=f"https://uploads.mangadex.org/covers/{slug}/{cover_file}.256.jpg",
-                headers=HEADERS,
+            thumbnail = client.get(
+                url=md_cover_url(slug, covers),
             ).content
 
-            chapters = request_with_retry(
+            chapters = client.get(
                 f"{BASE_URL}/manga/{slug}/feed",
                 params={"limit": 500},
             ).json()["data"]
@@ -248,15 +286,37 @@ def scrape_manga():
             manga.delete_instance()
 
 
-def request_with_retry(url, params=None):
-    while True:
-        response = requests.get(url, headers=HEADERS, params=params)
-        if response.status_code == 429:
-            print(f"[event/rate-limit] {url}")
-            until = int(response.headers["X-RateLimit-Retry-After"])
-            time.sleep(max(0.0, until - time.time()))
+# Chapters can be edited without the title changing, so feeds are refetched on their own.
+# Feeds that cannot be refetched, such as of deleted titles, keep the stored chapters.
+def refresh_feeds(mangas: list[MDManga]) -> dict[str, bool]:
+    changed = {}
+    for manga in mangas:
+        try:
+            response = client.get(
+                f"{BASE_URL}/manga/{manga.slug}/feed",
+                params={"limit": 500},
+            )
+            response.raise_for_status()
+            chapters = response.json()["data"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as error:
+            print(f"[refresh/fail] {manga.slug} {error}")
+            MDManga.update(last_fetched=utcnow()).where(MDManga.slug == manga.slug).execute()
+            changed[manga.slug] = False
             continue
-        return response
+
+        changed[manga.slug] = chapters != manga.chapters
+        print(f"[refresh/{'update' if changed[manga.slug] else 'same'}] {manga.slug}")
+        MDManga.update(chapters=chapters, last_fetched=utcnow()).where(MDManga.slug == manga.slug).execute()
+    return changed
+
+
+def md_page_url(page_data: dict) -> str:
+    return "/".join([
+        page_data["baseUrl"],
+        "data-saver",
+        page_data["chapter"]["hash"],
+        page_data["chapter"]["dataSaver"][0],
+    ])
 
 
 def scrape_chapters():
@@ -268,20 +328,14 @@ def scrape_chapters():
                 continue
             print(f"[chapter/new] {slug}")
 
-            page_data = request_with_retry(
+            page_data = client.get(
                 url=f"{BASE_URL}/at-home/server/{slug}",
             ).json()
 
-            cover_url = "/".join([
-                page_data["baseUrl"],
-                "data-saver",
-                page_data["chapter"]["hash"],
-                page_data["chapter"]["dataSaver"][0],
-            ])
+            cover_url = md_page_url(page_data)
 
-            cover = requests.get(
+            cover = client.get(
                 url=cover_url,
-                headers=HEADERS,
             ).content
 
             try:
@@ -301,7 +355,7 @@ def scrape_statistics():
     for manga in MDManga.select():
         print(f"[statistics/manga] {manga.slug}")
         manga_url = f"{BASE_URL}/statistics/manga/{manga.slug}"
-        title = request_with_retry(manga_url).json()["statistics"][manga.slug]
+        title = client.get(manga_url).json()["statistics"][manga.slug]
 
         chapter_uuids = []
         for chapter in manga.chapters:
@@ -310,9 +364,8 @@ def scrape_statistics():
         chapters = {}
         for start in range(0, len(chapter_uuids), batch_limit):
             batch = chapter_uuids[start:start + batch_limit]
-            chapters.update(requests.get(
+            chapters.update(client.get(
                 f"{BASE_URL}/statistics/chapter",
-                headers=HEADERS,
                 params={"chapter[]": batch}
             ).json()["statistics"])
 
@@ -327,6 +380,196 @@ def scrape_statistics():
         )
 
 
+# Shares the thread pool and database writer between scraping tasks.
+# Requests block, so they are made from a thread pool of `MD_CONCURRENCY` threads.
+class MDScraper:
+    executor: ThreadPoolExecutor
+    writes: asyncio.Queue
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(MD_CONCURRENCY)
+        self.writes = asyncio.Queue()
+
+    async def run(self, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    # Rate limits are waited for in the thread making the request.
+    async def get(self, url: str, params=None) -> Response:
+        return await self.run(functools.partial(client.get, url, params=params))
+
+    # Queries are executed by the writer in the order they are queued.
+    def write(self, function: Callable[[], object]):
+        self.writes.put_nowait(function)
+
+    # SQLite allows one writer at a time, so all writes are applied by a single task.
+    # Writes queued while a transaction is applied are committed together in the next one.
+    async def write_all(self):
+        while True:
+            writes = [await self.writes.get()]
+            while not self.writes.empty():
+                writes.append(self.writes.get_nowait())
+
+            with db.atomic():
+                for write in writes:
+                    if write is not None:
+                        write()
+            if None in writes:
+                return
+
+    @contextlib.asynccontextmanager
+    async def writer(self):
+        task = asyncio.create_task(self.write_all())
+        try:
+            yield
+        finally:
+            self.write(None)
+            await task
+
+
+async def scrape_manga_entry(scraper: MDScraper, entry: dict):
+    slug = entry["id"]
+    covers, chapters = await asyncio.gather(
+        scraper.get(f"{BASE_URL}/cover", params={"limit": 100, "manga[]": slug}),
+        scraper.get(f"{BASE_URL}/manga/{slug}/feed", params={"limit": 500}),
+    )
+
+    covers = covers.json()["data"]
+    if not covers:
+        print(f"[manga/uncovered] {slug}")
+        scraper.write(MDManga.delete().where(MDManga.slug == slug).execute)
+        return
+
+    thumbnail = (await scraper.get(md_cover_url(slug, covers))).content
+    chapters = chapters.json()["data"]
+    scraper.write(MDManga.replace(
+        slug=slug,
+        data=entry,
+        covers=covers,
+        chapters=chapters,
+        thumbnail=thumbnail,
+        last_fetched=utcnow(),
+    ).execute)
+
+
+async def scrape_manga_async(scraper: MDScraper):
+    limit = 100
+    existing = dict(MDManga.select(MDManga.slug, MDManga.data).tuples())
+
+    # The first page gives the total, so the other pages are requested together.
+    async def manga_page(offset: int) -> dict:
+        params = manga_params([("limit", limit), ("offset", offset)])
+        return (await scraper.get(f"{BASE_URL}/manga", params=params)).json()
+
+    first_page = await manga_page(0)
+    pages = [first_page] + await asyncio.gather(*[
+        manga_page(offset)
+        for offset in range(limit, first_page["total"], limit)
+    ])
+
+    all_slugs = set()
+    tasks = []
+    for page in pages:
+        for entry in page["data"]:
+            slug = entry["id"]
+            all_slugs.add(slug)
+
+            if slug in existing:
+                if existing[slug] == entry:
+                    print(f"[manga/skip] {slug}")
+                    continue
+                print(f"[manga/update] {slug}")
+            else:
+                print(f"[manga/new] {slug}")
+            tasks.append(scrape_manga_entry(scraper, entry))
+    await asyncio.gather(*tasks)
+
+    # Remove orphan titles.
+    for slug in existing.keys() - all_slugs:
+        print(f"[manga/orphan] {slug}")
+        scraper.write(MDManga.delete().where(MDManga.slug == slug).execute)
+
+
+async def scrape_chapter(scraper: MDScraper, slug: str):
+    page_data = (await scraper.get(f"{BASE_URL}/at-home/server/{slug}")).json()
+    cover_url = md_page_url(page_data)
+    cover = (await scraper.get(cover_url)).content
+
+    try:
+        thumbnail = await scraper.run(create_thumbnail, cover)
+    except PIL.UnidentifiedImageError:
+        print(f"[page/failure] {cover_url}")
+        return
+    scraper.write(MDChapter.replace(slug=slug, thumbnail=thumbnail).execute)
+
+
+async def scrape_chapters_async(scraper: MDScraper):
+    scraped = {slug for slug, in MDChapter.select(MDChapter.slug).tuples()}
+    tasks = []
+    for manga in select_without_thumbnail(MDManga):
+        for chapter in manga.chapters:
+            slug = chapter["id"]
+            if slug in scraped:
+                print(f"[chapter/skip] {slug}")
+                continue
+            print(f"[chapter/new] {slug}")
+            scraped.add(slug)
+            tasks.append(scrape_chapter(scraper, slug))
+    await asyncio.gather(*tasks)
+
+
+# Written for titles and chapters left out of a statistics response, as every title
+# read by the build must have statistics.
+MISSING_TITLE_STATISTICS = {"comments": None, "rating": {"average": None, "bayesian": 0}, "follows": 0}
+MISSING_CHAPTER_STATISTICS = {"comments": None}
+
+
+# Statistics are requested for up to 100 titles or chapters at once, across titles.
+async def scrape_statistics_async(scraper: MDScraper):
+    batch_limit = 100
+    mangas = list(select_without_thumbnail(MDManga))
+    chapter_uuids = [chapter["id"] for manga in mangas for chapter in manga.chapters]
+    titles = {}
+    chapters = {}
+
+    async def statistics(route: str, key: str, uuids: list[str], results: dict):
+        response = await scraper.get(f"{BASE_URL}/statistics/{route}", params={key: uuids})
+        results.update(response.json()["statistics"])
+
+    await asyncio.gather(*[
+        statistics("manga", "manga[]", [manga.slug for manga in mangas[start:start + batch_limit]], titles)
+        for start in range(0, len(mangas), batch_limit)
+    ], *[
+        statistics("chapter", "chapter[]", chapter_uuids[start:start + batch_limit], chapters)
+        for start in range(0, len(chapter_uuids), batch_limit)
+    ])
+
+    for manga in mangas:
+        if manga.slug in titles:
+            print(f"[statistics/manga] {manga.slug}")
+        else:
+            print(f"[statistics/missing] {manga.slug}")
+
+        scraper.write(MDStatistics.replace(
+            manga=manga,
+            title=titles.get(manga.slug, MISSING_TITLE_STATISTICS),
+            chapters={
+                chapter["id"]: chapters.get(chapter["id"], MISSING_CHAPTER_STATISTICS)
+                for chapter in manga.chapters
+            },
+        ).execute)
+
+
+async def scrape_async():
+    scraper = MDScraper()
+    with scraper.executor:
+        async with scraper.writer():
+            await scrape_manga_async(scraper)
+        async with scraper.writer():
+            await scrape_chapters_async(scraper)
+        async with scraper.writer():
+            await scrape_statistics_async(scraper)
+
+
 def main():
     db.connect()
     db.create_tables([
@@ -335,9 +578,12 @@ def main():
         MDStatistics,
     ])
 
-    scrape_manga()
-    scrape_chapters()
-    scrape_statistics()
+    if MD_CONCURRENCY > 1:
+        asyncio.run(scrape_async())
+    else:
+        scrape_manga()
+        scrape_chapters()
+        scrape_statistics()
 
 
 if __name__ == '__main__':
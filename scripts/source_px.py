@@ -1,18 +1,17 @@
 import json
 import re
-import time
 
-import requests
 from peewee import SqliteDatabase, Model, IntegerField
 from playhouse.sqlite_ext import JSONField
 
 from scripts.source_db import DBEntry, db_pixiv_id
-from scripts.utility import HEADERS, tracing_response_hook
+from scripts.http_client import HttpClient, HostPolicy
 
 db = SqliteDatabase("data/px.db")
-requests = requests.Session()
-requests.hooks["response"].append(tracing_response_hook)
 REQUEST_DELAY_SECONDS = 2.5
+client = HttpClient({
+    "rdtls.nl": HostPolicy(rate=1 / REQUEST_DELAY_SECONDS),
+})
 
 
 class BaseModel(Model):
@@ -40,11 +39,9 @@ def get_pixiv_entry(pixiv_id: int) -> PXEntry | None:
 
 
 def request_pixiv_metadata(pixiv_id: int):
-    time.sleep(REQUEST_DELAY_SECONDS)
-    response = requests.get(
+    response = client.get(
         "https://rdtls.nl/pixiv.php",
         params={"site": "pixiv", "id": pixiv_id},
-        headers=HEADERS,
     )
 
     if not response.ok:
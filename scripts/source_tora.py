@@ -9,8 +9,10 @@ from lxml.cssselect import CSSSelector
 from peewee import SqliteDatabase, Model, CharField, BlobField
 
 from scripts.date_time_utc_field import DateTimeUTCField
-from scripts.utility import get_with_proxy, strain_html, utcnow, OutOfCreditsError
+from scripts.http_client import HttpClient, get_with_proxy
+from scripts.utility import strain_html, utcnow, OutOfCreditsError, select_without_thumbnail
 
+client = HttpClient()
 db = SqliteDatabase("data/tora.db")
 
 
@@ -38,7 +40,7 @@ class ToraDataEntry:
     characters: list[str]
     circles: list[str]
     authors: list[str]
-    thumbnail: bytes
+    thumbnail: bytes | None
 
 
 def parse_tora_entry(entry) -> ToraDataEntry:
@@ -110,9 +112,11 @@ def parse_tora_entry(entry) -> ToraDataEntry:
     )
 
 
-def tora_entries() -> list[ToraDataEntry]:
+# Thumbnails may be omitted and read later from `ToraEntry`.
+def tora_entries(thumbnails: bool = True) -> list[ToraDataEntry]:
     entries = []
-    for entry in ToraEntry.select():
+    query = ToraEntry.select() if thumbnails else select_without_thumbnail(ToraEntry)
+    for entry in query:
         try:
             entries.append(parse_tora_entry(entry))
         except (TypeError, ValueError):
@@ -159,7 +163,7 @@ def source_tora():
                     continue
 
                 # FIXME: Handle empty thumbnail.
-                thumbnail = requests.get(image_url).content
+                thumbnail = client.get(image_url).content
                 # The listing link carries the correct store path; a hardcoded
                 # `/tora/ec/item/` path 404s digital items.
                 product_url = f"https://ecs.toranoana.jp{product_path}"
@@ -182,6 +186,39 @@ def source_tora():
             page_number += 1
 
 
+# Pages are compared by their parsed details, as the rest of the page changes on every request.
+# Pages that can no longer be parsed, such as age-gate pages, keep the stored page.
+# Products refreshed before credits ran out are still returned.
+def refresh_products(entries: list[ToraEntry]) -> dict[str, bool]:
+    changed = {}
+    query = select_without_thumbnail(ToraEntry).where(ToraEntry.id << [entry.id for entry in entries])
+    for entry in query:
+        try:
+            details = parse_tora_entry(entry)
+            data = get_with_proxy(details.url, retries=10).content
+        except OutOfCreditsError as e:
+            print(f"[credits/exhausted] {e}")
+            return changed
+        except (requests.exceptions.RequestException, TypeError, ValueError) as error:
+            print(f"[refresh/fail] {entry.id} {error}")
+            ToraEntry.update(last_fetched=utcnow()).where(ToraEntry.id == entry.id).execute()
+            changed[entry.id] = False
+            continue
+
+        try:
+            fetched = parse_tora_entry(ToraEntry(id=entry.id, data=ToraEntry.data.adapt(data)))
+        except (TypeError, ValueError):
+            print(f"[refresh/invalid] {entry.id}")
+            ToraEntry.update(last_fetched=utcnow()).where(ToraEntry.id == entry.id).execute()
+            changed[entry.id] = False
+            continue
+
+        changed[entry.id] = fetched != details
+        print(f"[refresh/{'update' if changed[entry.id] else 'same'}] {entry.id}")
+        ToraEntry.update(data=data, last_fetched=utcnow()).where(ToraEntry.id == entry.id).execute()
+    return changed
+
+
 def main():
     db.connect()
     db.create_tables([ToraEntry])
@@ -0,0 +1,479 @@
+import io
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+from peewee import chunked
+from PIL import Image, ImageDraw, ImageOps
+
+from .data_comic_thproject_net import CTHEntry, db as cth_db
+from .data_doujinshi_org import OrgEntry, db as org_db
+from .source_db import DBEntry, DBArtist, DBCommentCount, DBWikiPage, DBPoolDescription, db as db_db, \
+    render_pool_descriptions
+from .source_ds import DSEntry, DSTopic, DSEntryTopicSlug, db as ds_db
+from .source_eh import EHEntry, db as eh_db
+from .source_mb import MBEntry, db as mb_db
+from .source_md import MDManga, MDChapter, MDStatistics, db as md_db
+from .source_px import PXEntry, db as px_db
+from .source_tora import ToraEntry, db as tora_db
+
+# Share of entries generated for each source.
+SOURCE_SHARES = {
+    "eh": 0.40,
+    "db": 0.12,
+    "ds": 0.08,
+    "md": 0.10,
+    "mb": 0.12,
+    "tora": 0.12,
+    "org": 0.04,
+    "cth": 0.02,
+}
+
+# Each work appears in this many sources on average.
+ENTRIES_PER_WORK = 2
+BATCH_SIZE = 1000
+EPOCH = datetime(2008, 1, 1, tzinfo=timezone.utc)
+
+CHARACTERS = {
+    "hakurei_reimu": ["博麗霊夢", "霊夢"],
+    "kirisame_marisa": ["霧雨魔理沙", "魔理沙"],
+    "alice_margatroid": ["アリス・マーガトロイド"],
+    "izayoi_sakuya": ["十六夜咲夜", "咲夜"],
+    "remilia_scarlet": ["レミリア・スカーレット"],
+    "flandre_scarlet": ["フランドール・スカーレット"],
+    "patchouli_knowledge": ["パチュリー・ノーレッジ"],
+    "konpaku_youmu": ["魂魄妖夢"],
+    "saigyouji_yuyuko": ["西行寺幽々子"],
+    "yakumo_yukari": ["八雲紫"],
+    "kochiya_sanae": ["東風谷早苗"],
+    "komeiji_satori": ["古明地さとり"],
+    "komeiji_koishi": ["古明地こいし"],
+    "cirno": ["チルノ"],
+    "fujiwara_no_mokou": ["藤原妹紅"],
+    "kamishirasawa_keine": ["上白沢慧音"],
+    "reisen_udongein_inaba": ["鈴仙・優曇華院・イナバ"],
+    "shameimaru_aya": ["射命丸文"],
+    "maribel_hearn": ["マエリベリー・ハーン"],
+    "usami_renko": ["宇佐見蓮子"],
+}
+
+TAGS = ["Comedy", "Romance", "Drama", "Slice of Life", "Girls' Love", "Action", "4-Koma", "Full Color"]
+LANGUAGES = ["english", "chinese", "spanish", "korean"]
+
+
+def character_name(tag: str) -> str:
+    return tag.replace("_", " ").title()
+
+
+class Work:
+    index: int
+    seed: int
+    title: str
+    title_jpn: str
+    circle: str
+    artist: str
+    characters: list[str]
+    tags: list[str]
+    date: datetime
+    pages: int
+
+    def __init__(self, rng: random.Random, index: int):
+        self.index = index
+        self.seed = rng.randrange(2 ** 32)
+        self.title = f"{rng.choice(['Scarlet', 'Lunatic', 'Border', 'Spring', 'Phantom'])} {rng.choice(['Dream', 'Tea Party', 'Festival', 'Night', 'Letter'])} {index}"
+        self.title_jpn = f"東方作品{index}"
+        self.circle = f"Circle {rng.randrange(max(1, index // 8) + 1)}"
+        self.artist = f"artist {rng.randrange(max(1, index // 4) + 1)}"
+        self.characters = rng.sample(list(CHARACTERS.keys()), rng.randint(1, 3))
+        self.tags = rng.sample(TAGS, rng.randint(0, 3))
+        self.date = EPOCH + timedelta(days=rng.randrange(5800), seconds=rng.randrange(86400))
+        self.pages = rng.randint(8, 60)
+
+
+def work_cover(work: Work) -> Image.Image:
+    rng = random.Random(work.seed)
+    width, height = 180, 256
+    image = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(6, 14)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randint(20, 120), rng.randint(20, 120)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle((x, y, x + w, y + h), fill=color)
+        else:
+            draw.ellipse((x, y, x + w, y + h), fill=color)
+    return image
+
+
+# Near-duplicate covers as sources re-encode, rescale and pad them differently.
+def variant_thumbnail(rng: random.Random, cover: Image.Image) -> bytes:
+    image = cover
+    if rng.random() < 0.3:
+        image = ImageOps.expand(image, border=rng.randint(4, 20), fill=rng.choice(["white", "black"]))
+    if rng.random() < 0.3:
+        width, height = image.size
+        image = image.crop((rng.randint(0, 6), rng.randint(0, 6), width - rng.randint(0, 6), height))
+    if rng.random() < 0.1:
+        # Spread of two pages side by side.
+        spread = Image.new("RGB", (image.width * 2, image.height), "white")
+        spread.paste(image, (0, 0))
+        image = spread
+
+    scale = rng.uniform(0.8, 1.4)
+    image = image.resize((int(image.width * scale), int(image.height * scale)))
+    with io.BytesIO() as buffer:
+        image.save(buffer, format="JPEG", quality=rng.randint(60, 95))
+        return buffer.getvalue()
+
+
+def write_rows(model, rows):
+    with model._meta.database.atomic():
+        for batch in chunked(rows, BATCH_SIZE):
+            model.insert_many(batch).execute()
+
+
+def eh_rows(rng, works, thumbnail):
+    for gid, work in enumerate(works, start=100000):
+        language = rng.choice(LANGUAGES) if rng.random() < 0.4 else None
+        tags = ["parody:touhou project", f"group:{work.circle.lower()}", f"artist:{work.artist}"]
+        tags += [f"character:{character_name(c).lower()}" for c in work.characters]
+        tags += [f"other:{tag.lower()}" for tag in work.tags]
+        if language:
+            tags += ["language:translated", f"language:{language}"]
+
+        suffix = f" [{language.title()}]" if language else ""
+        yield {
+            "gid": gid,
+            "data": {
+                "gid": gid,
+                "token": f"{rng.getrandbits(40):010x}",
+                "archiver_key": f"{rng.getrandbits(64):016x}",
+                "title": f"(Reitaisai {rng.randint(1, 20)}) [{work.circle} ({work.artist})] {work.title} (Touhou Project){suffix}",
+                "title_jpn": f"(例大祭{rng.randint(1, 20)}) [{work.circle}] {work.title_jpn} (東方Project)",
+                "category": "Doujinshi",
+                "thumb": f"https://ehgt.org/00/00/{gid}-l.jpg",
+                "uploader": f"uploader{rng.randrange(500)}",
+                "posted": str(int(work.date.timestamp())),
+                "filecount": str(work.pages),
+                "filesize": rng.randrange(10 ** 6, 10 ** 8),
+                "expunged": False,
+                "rating": f"{rng.uniform(3, 5):.2f}",
+                "torrentcount": "0",
+                "tags": tags,
+            },
+            "thumbnail": thumbnail(work),
+            "last_fetched": EPOCH,
+        }
+
+
+def db_rows(rng, works, thumbnail, post_ids):
+    for pool_id, work in enumerate(works, start=1):
+        posts = []
+        for _ in range(rng.randint(4, 30)):
+            post_id = next(post_ids)
+            characters = " ".join(work.characters)
+            posts.append({
+                "id": post_id,
+                "created_at": work.date.isoformat(),
+                "rating": rng.choices(["g", "s", "q", "e"], [80, 15, 4, 1])[0],
+                "tag_string": f"touhou {characters} {work.artist.replace(' ', '_')} comic",
+                "tag_string_general": "comic " + ("english_text" if rng.random() < 0.5 else "translated"),
+                "tag_string_character": characters,
+                "tag_string_copyright": "touhou",
+                "tag_string_artist": work.artist.replace(" ", "_"),
+                "tag_string_meta": "translated" if rng.random() < 0.6 else "commentary_request",
+                "pixiv_id": None,
+                "preview_file_url": f"https://cdn.donmai.us/preview/{post_id}.jpg",
+                "media_asset": {"variants": [
+                    {"type": "180x180", "url": f"https://cdn.donmai.us/180x180/{post_id}.jpg"},
+                    {"type": "360x360", "url": f"https://cdn.donmai.us/360x360/{post_id}.jpg"},
+                ]},
+            })
+
+        yield {
+            "pool_id": pool_id,
+            "data": {
+                "id": pool_id,
+                "name": f"Touhou_-_{work.title.replace(' ', '_')}_({work.artist.replace(' ', '_')})",
+                "created_at": work.date.isoformat(),
+                "updated_at": work.date.isoformat(),
+                "description": f"Translated by [[{work.artist}]]. h4. Notes\n* Source: pixiv",
+                "is_active": False,
+                "is_deleted": False,
+                "post_ids": [post["id"] for post in posts],
+                "category": "series",
+                "post_count": len(posts),
+            },
+            "posts": posts,
+            "thumbnail": thumbnail(work),
+            "last_fetched": EPOCH,
+        }
+
+
+def ds_rows(rng, works, thumbnail):
+    for index, work in enumerate(works):
+        slug = f"{work.title.lower().replace(' ', '_')}_{index}"
+        tags = [{"type": "Author", "name": work.artist.title(), "permalink": work.artist.replace(" ", "_")}]
+        tags += [{"type": "General", "name": tag, "permalink": tag.lower()} for tag in work.tags]
+        if len(work.characters) >= 2:
+            pairing = " x ".join(character_name(c).split()[-1] for c in work.characters[:2])
+            tags.append({"type": "Pairing", "name": pairing, "permalink": pairing.lower().replace(" ", "_")})
+        if rng.random() < 0.2:
+            tags.append({"type": "Series", "name": f"{work.title} Series", "permalink": f"series_{work.index}"})
+        if rng.random() < 0.02:
+            tags.append({"type": "General", "name": "NSFW", "permalink": "nsfw"})
+
+        yield {
+            "slug": slug,
+            "data": {
+                "title": work.title,
+                "long_title": f"{work.title} (Touhou Project)",
+                "permalink": slug,
+                "released_on": work.date.date().isoformat(),
+                "added_on": work.date.isoformat(),
+                "tags": tags,
+                "pages": [{"name": f"{page:02}", "url": f"/system/releases/{slug}/{page:02}.jpg"}
+                          for page in range(work.pages)],
+            },
+            "thumbnail": thumbnail(work),
+            "last_fetched": EPOCH,
+        }
+
+
+def md_rows(rng, works, thumbnail):
+    mangas, chapters, statistics = [], [], []
+    for start in range(0, len(works), 3):
+        group = works[start:start + 3]
+        slug = f"00000000-0000-4000-8000-{start:012}"
+        manga_chapters = []
+        for number, work in enumerate(group, start=1):
+            chapter_slug = f"00000000-0000-4000-9000-{start + number:012}"
+            manga_chapters.append({
+                "id": chapter_slug,
+                "type": "chapter",
+                "attributes": {
+                    "volume": None,
+                    "chapter": str(number),
+                    "title": work.title if rng.random() < 0.5 else None,
+                    "translatedLanguage": rng.choice(["en", "en", "es", "ru", "pt-br"]),
+                    "publishAt": work.date.isoformat(),
+                    "pages": work.pages,
+                },
+            })
+            if rng.random() < 0.7:
+                chapters.append({"slug": chapter_slug, "thumbnail": thumbnail(work)})
+
+        first = group[0]
+        mangas.append({
+            "slug": slug,
+            "data": {
+                "id": slug,
+                "type": "manga",
+                "attributes": {
+                    "title": {"en": f"Touhou - {first.title} (Doujinshi)"},
+                    "altTitles": [{"ja": first.title_jpn}],
+                    "description": {"en": f"A story about {character_name(first.characters[0])}.\nTranslated."},
+                    "tags": [{"attributes": {"name": {"en": tag}}} for tag in first.tags + ["Doujinshi"]],
+                },
+                "relationships": [
+                    {"type": "author", "attributes": {"name": first.artist.title()}},
+                    {"type": "artist", "attributes": {"name": first.artist.title()}},
+                ],
+            },
+            "covers": [{"attributes": {"volume": None, "createdAt": first.date.isoformat(), "fileName": "cover.jpg"}}],
+            "chapters": manga_chapters,
+            "thumbnail": thumbnail(first),
+            "last_fetched": EPOCH,
+        })
+        statistics.append({
+            "manga": slug,
+            "title": {"comments": {"repliesCount": rng.randrange(50)} if rng.random() < 0.5 else None},
+            "chapters": {
+                chapter["id"]: {"comments": {"repliesCount": rng.randrange(20)} if rng.random() < 0.5 else None}
+                for chapter in manga_chapters
+            },
+        })
+    return mangas, chapters, statistics
+
+
+def mb_page(rng, work: Work, product_id: int) -> str:
+    characters = "".join(
+        f'<a href="https://www.melonbooks.co.jp/tags/index.php?chara={c}">#{CHARACTERS[c][0]}</a>'
+        for c in work.characters
+    )
+    return f"""<html><body><div class="item-page">
+<h1>{work.title_jpn}</h1>
+<p class="circle"><a href="https://www.melonbooks.co.jp/circle/index.php?circle_id={product_id % 997}">{work.circle}</a></p>
+<p class="author"><a href="https://www.melonbooks.co.jp/search/search.php?name={work.artist}&text_type=author">{work.artist}</a></p>
+<table>
+<tr><th>ジャンル</th><td>東方Project</td></tr>
+<tr><th>発行日</th><td>{work.date.strftime('%Y/%m/%d')}</td></tr>
+<tr><th>総ページ数・CG数・曲数</th><td>{work.pages}</td></tr>
+</table>
+<div>{characters}</div>
+<div class="item-detail mt24"><h3>商品紹介</h3><p>{work.title_jpn}の本です。</p></div>
+</div></body></html>"""
+
+
+def mb_rows(rng, works, thumbnail):
+    for product_id, work in enumerate(works, start=200000):
+        yield {
+            "id": product_id,
+            "data": mb_page(rng, work, product_id),
+            "thumbnail": thumbnail(work) if rng.random() < 0.95 else None,
+            "last_fetched": EPOCH,
+        }
+
+
+def tora_page(rng, work: Work, product_id: str) -> str:
+    characters = "".join(f'<a href="/tags/{c}">{CHARACTERS[c][0]}</a>' for c in work.characters)
+    pairing = "×".join(CHARACTERS[c][-1] for c in work.characters[:2])
+    return f"""<html><head><link rel="canonical" href="https://ecs.toranoana.jp/tora/ec/item/{product_id}/"></head><body>
+<h1 class="product-detail-desc-title"><span>{work.title_jpn}</span></h1>
+<div class="product-detail-spec"><table>
+<tr><td>サークル名</td><td><a href="/circle/{work.index}">{work.circle}</a></td></tr>
+<tr><td>作家</td><td><a href="/author/{work.index}">{work.artist}</a></td></tr>
+<tr><td>発行日</td><td>{work.date.strftime('%Y/%m/%d')}</td></tr>
+<tr><td>種別/サイズ</td><td>同人誌 B5 {work.pages}p</td></tr>
+<tr><td>カップリング</td><td><a href="/coupling/{work.index}">{pairing}</a></td></tr>
+<tr><td>メインキャラ</td><td>{characters}</td></tr>
+</table></div>
+<div class="product-detail-comment"><div class="product-detail-comment-item"><h3>内容紹介</h3><p>{work.title_jpn}</p></div></div>
+</body></html>"""
+
+
+def tora_rows(rng, works, thumbnail):
+    for index, work in enumerate(works):
+        product_id = f"04{index:08}"
+        yield {
+            "id": product_id,
+            "data": tora_page(rng, work, product_id),
+            "thumbnail": thumbnail(work),
+            "last_fetched": EPOCH,
+        }
+
+
+def org_rows(rng, works, thumbnail):
+    for book_id, work in enumerate(works, start=1):
+        yield {
+            "id": book_id,
+            "titles": [work.title, work.title_jpn],
+            "release_date": work.date.date().isoformat(),
+            "characters": [character_name(c) for c in work.characters],
+            "authors": [work.artist],
+            "circles": [work.circle],
+            "pages": work.pages,
+            "thumbnail": thumbnail(work),
+            "comments": None,
+        }
+
+
+def cth_rows(rng, works, thumbnail):
+    for index, work in enumerate(works, start=1):
+        yield {
+            "id": index,
+            "title": work.title_jpn,
+            "pages": work.pages,
+            "thumbnail": thumbnail(work),
+            "release_date": work.date,
+        }
+
+
+# Writes `<directory>/data/*.db` with roughly `entry_count` entries across all sources.
+def generate(directory: str, entry_count: int, seed: int = 0):
+    rng = random.Random(seed)
+    works = [Work(rng, index) for index in range(max(1, entry_count // ENTRIES_PER_WORK))]
+
+    covers = {}
+
+    def thumbnail(work: Work) -> bytes:
+        # Bound memory by keeping only recently used covers.
+        if work.index not in covers:
+            if len(covers) > 1000:
+                covers.clear()
+            covers[work.index] = work_cover(work)
+        return variant_thumbnail(rng, covers[work.index])
+
+    def sample(source: str) -> list[Work]:
+        count = int(entry_count * SOURCE_SHARES[source])
+        return sorted(rng.choices(works, k=count), key=lambda work: work.index)
+
+    os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+    databases = [eh_db, db_db, ds_db, md_db, mb_db, tora_db, org_db, cth_db, px_db]
+    for database in databases:
+        path = os.path.join(directory, database.database)
+        if os.path.exists(path):
+            os.remove(path)
+        database.init(path)
+        database.connect(reuse_if_open=True)
+
+    eh_db.create_tables([EHEntry])
+    db_db.create_tables([DBEntry, DBArtist, DBCommentCount, DBWikiPage, DBPoolDescription])
+    ds_db.create_tables([DSEntry, DSTopic, DSEntryTopicSlug])
+    md_db.create_tables([MDManga, MDChapter, MDStatistics])
+    mb_db.create_tables([MBEntry])
+    tora_db.create_tables([ToraEntry])
+    org_db.create_tables([OrgEntry])
+    cth_db.create_tables([CTHEntry])
+    px_db.create_tables([PXEntry])
+
+    print("[synthetic/eh]")
+    write_rows(EHEntry, eh_rows(rng, sample("eh"), thumbnail))
+
+    print("[synthetic/db]")
+    post_ids = iter(range(1, 10 ** 9))
+    write_rows(DBEntry, db_rows(rng, sample("db"), thumbnail, post_ids))
+    pool_ids = [row.pool_id for row in DBEntry.select(DBEntry.pool_id)]
+    write_rows(DBCommentCount, ({
+        "pool": pool_id,
+        "count": rng.randrange(8),
+    } for pool_id in pool_ids))
+    render_pool_descriptions(renderer="plain")
+    write_rows(DBWikiPage, ({
+        "title": character,
+        "data": {"title": character, "other_names": other_names},
+    } for character, other_names in CHARACTERS.items()))
+
+    print("[synthetic/ds]")
+    write_rows(DSEntry, ds_rows(rng, sample("ds"), thumbnail))
+    slugs = [row.slug for row in DSEntry.select(DSEntry.slug)]
+    write_rows(DSTopic, ({
+        "slug": f"topic_{slug}",
+        "subject": slug,
+        "views": rng.randrange(10000),
+        "comments": rng.randrange(100),
+    } for slug in slugs))
+    write_rows(DSEntryTopicSlug, ({"entry": slug, "topic_slug": f"topic_{slug}"} for slug in slugs))
+
+    print("[synthetic/md]")
+    mangas, chapters, statistics = md_rows(rng, sample("md"), thumbnail)
+    write_rows(MDManga, mangas)
+    write_rows(MDChapter, chapters)
+    write_rows(MDStatistics, statistics)
+
+    print("[synthetic/mb]")
+    write_rows(MBEntry, mb_rows(rng, sample("mb"), thumbnail))
+
+    print("[synthetic/tora]")
+    write_rows(ToraEntry, tora_rows(rng, sample("tora"), thumbnail))
+
+    print("[synthetic/org]")
+    write_rows(OrgEntry, org_rows(rng, sample("org"), thumbnail))
+
+    print("[synthetic/cth]")
+    write_rows(CTHEntry, cth_rows(rng, sample("cth"), thumbnail))
+
+    for database in databases:
+        database.close()
+
+
+# Usage: python -m scripts.synthetic_corpus <directory> <entry count>
+def main():
+    directory, entry_count = sys.argv[1], int(sys.argv[2])
+    generate(directory, entry_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,11 @@
 import datetime
 import io
-import os
 from typing import TypeVar
-from urllib.parse import urlencode
 from pprint import pprint
 
 import requests
 from PIL import Image, ImageFile
+from peewee import Model
 
 T = TypeVar("T")
 
@@ -14,6 +13,8 @@ HEADERS = {
     "User-Agent": "TouhouIndexBot/0.1 (+https://scarlet.nsk.sh)"
 }
 
+THUMBNAIL_SIZE = (256, 256)
+
 
 def utcnow() -> datetime.datetime:
     return datetime.datetime.now(datetime.timezone.utc)
@@ -26,11 +27,32 @@ def deduplicate_by_identity(xs: list[T]) -> list[T]:
     return list(objects.values())
 
 
+# Selects every column except the thumbnail, which can be read lazily with `read_thumbnail`.
+def select_without_thumbnail(model: type[Model]):
+    return model.select(*[field for field in model._meta.sorted_fields
+                          if field.name != "thumbnail"])
+
+
+def read_thumbnail(model: type[Model], key) -> bytes | None:
+    return (model.select(model.thumbnail)
+            .where(model._meta.primary_key == key)
+            .scalar())
+
+
+# JPEGs are decoded at a reduced scale when the image will be shrunk to `size` or smaller.
+# The decoded image is at least twice `size`, the same margin that `Image.thumbnail` uses.
+def load_image(data: bytes, size: tuple[int, int] = None) -> Image:
+    image = Image.open(io.BytesIO(data))
+    if size and image.format == "JPEG":
+        image.draft(None, (size[0] * 2, size[1] * 2))
+    return image
+
+
 def create_thumbnail(data: bytes) -> bytes:
     ImageFile.LOAD_TRUNCATED_IMAGES = True
     with io.BytesIO() as buffer:
-        thumbnail = Image.open(io.BytesIO(data)).convert("RGB")
-        thumbnail.thumbnail((256, 256))
+        thumbnail = load_image(data, THUMBNAIL_SIZE).convert("RGB")
+        thumbnail.thumbnail(THUMBNAIL_SIZE)
         thumbnail.save(buffer, format="JPEG")
         return buffer.getvalue()
 
@@ -62,45 +84,6 @@ class OutOfCreditsError(Exception):
     pass
 
 
-def get_with_proxy(
-    url: str,
-    retries: int,
-    params: dict[str, str | int] = None,
-    with_browser: bool = False,
-    proxy_country: str = None,
-):
-    request_params = {
-        "url": f"{url}?{urlencode(params or {})}",
-        "x-api-key": os.environ["SCRAPINGANT_API_KEY"],
-    }
-
-    if with_browser:
-        request_params["return_page_source"] = "true"
-    else:
-        request_params["browser"] = "false"
-
-    if proxy_country:
-        request_params["proxy_country"] = proxy_country
-
-    attempt = 0
-    while attempt < retries:
-        response = requests.get(
-            "https://api.scrapingant.com/v2/general",
-            params=request_params
-        )
-
-        if response.status_code == 200:
-            return response
-
-        # ScrapingAnt returns 403 when the plan credit limit is reached.
-        if response.status_code == 403:
-            raise OutOfCreditsError(f"credits exhausted: {request_params['url']}")
-
-        attempt += 1
-        print(f"[retry/{response.status_code}] {request_params['url']}")
-    raise ValueError(f"Failed to fetch: {request_params['url']}")
-
-
 def tracing_response_hook(response: requests.Response, *_args, **_kwargs):
     if not response.ok:
         print(f"[response/{response.status_code}] {response.url}")
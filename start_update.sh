@@ -1,6 +1,9 @@
+# Stages are recorded in data/build_report.json under this run.
+export BUILD_RUN_ID="$(date -u +%Y-%m-%dT%H:%M:%SZ)"
+
 run() {
   echo "[stage] $1 $(date -u +%Y-%m-%dT%H:%M:%SZ)"
-  pdm run python3 -u -m "scripts.$1"
+  pdm run python3 -u -m scripts.build_report "$1"
 }
 
 # Detached: Coolify kills the task's ssh session after 1h and retries it,
@@ -12,10 +15,12 @@ run() {
   run source_md;
   run source_mb;
   run source_tora;
+  run refresh_scheduler;
   # run source_px;
   run build_image_hashes &&
   run build_index &&
   run collate_statistics;
+  pdm run python3 -u -m scripts.build_report;
   echo "[stage] end $(date -u +%Y-%m-%dT%H:%M:%SZ)"
 } &> data/update.log < /dev/null &
 
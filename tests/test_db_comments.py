@@ -0,0 +1,76 @@
+from scripts import source_db
+from scripts.source_db import DBCommentCount, DBEntry
+
+
+class CommentsResponse:
+    def __init__(self, comments: list[dict]):
+        self.comments = comments
+
+    def json(self) -> list[dict]:
+        return self.comments
+
+
+class CommentsClient:
+    def __init__(self, comments: list[dict]):
+        self.comments = comments
+
+    def get(self, url: str, params: dict = None) -> CommentsResponse:
+        post_ids = {int(post_id) for post_id in params["search[post_id]"].split(",")}
+        return CommentsResponse([comment for comment in self.comments if comment["post_id"] in post_ids])
+
+
+def create_pool(pool_id: int, post_ids: list[int]):
+    DBEntry.create(
+        pool_id=pool_id,
+        data={"post_ids": post_ids},
+        posts=[{"id": post_id} for post_id in post_ids],
+        thumbnail=b"",
+    )
+
+
+def use_database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    source_db.db.connect()
+
+
+def comment_count(pool_id: int) -> int:
+    return DBCommentCount.get(pool=pool_id).count
+
+
+# Deleted comments are listed by Danbooru and have always been counted.
+def test_comment_counts_include_deleted_comments(tmp_path, monkeypatch):
+    use_database(tmp_path, monkeypatch)
+    try:
+        source_db.create_tables()
+        create_pool(1, [10, 11])
+        create_pool(2, [20])
+        monkeypatch.setattr(source_db, "client", CommentsClient([
+            {"id": 1, "post_id": 10, "is_deleted": False},
+            {"id": 2, "post_id": 10, "is_deleted": True},
+            {"id": 3, "post_id": 11, "is_deleted": False},
+        ]))
+        source_db.scrape_comments()
+
+        assert comment_count(1) == 3
+        assert comment_count(2) == 0
+    finally:
+        source_db.db.close()
+
+
+# Counts of the older layout are readable by the build before comments are synced again.
+def test_comment_counts_are_migrated(tmp_path, monkeypatch):
+    use_database(tmp_path, monkeypatch)
+    try:
+        source_db.db.create_tables([DBEntry])
+        source_db.db.execute_sql("CREATE TABLE dbcomments (id INTEGER NOT NULL PRIMARY KEY, "
+                                 "pool_id INTEGER NOT NULL, comments TEXT NOT NULL)")
+        create_pool(1, [10])
+        source_db.db.execute_sql("INSERT INTO dbcomments (pool_id, comments) VALUES "
+                                 "(1, '[{\"id\": 1}, {\"id\": 2, \"is_deleted\": true}]')")
+        source_db.create_tables()
+
+        assert not source_db.db.table_exists("dbcomments")
+        assert comment_count(1) == 2
+    finally:
+        source_db.db.close()
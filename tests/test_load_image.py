@@ -0,0 +1,76 @@
+import io
+
+import numpy
+import pytest
+from PIL import Image, ImageDraw, ImageOps
+
+from scripts import image_hashing
+from scripts.image_hashing import candidate_images, image_hashes
+from scripts.entry_list_image_tree import COARSE_SIMILARITY_SLACK, FINE_DISTANCE_SCALE
+from scripts.utility import THUMBNAIL_SIZE, create_thumbnail, load_image
+
+# The strictest similarity that entries are grouped at.
+SIMILARITY = 0.9
+MAX_H8_DISTANCE = int((1.0 - SIMILARITY + COARSE_SIMILARITY_SLACK) * (8 * 8))
+MAX_H16_DISTANCE = int((1.0 - SIMILARITY) * FINE_DISTANCE_SCALE * (16 * 16))
+
+
+# Smooth noise with a few shapes, roughly like a cover.
+# A border makes `candidate_images` add a trimmed candidate.
+def cover_jpeg(seed: int, size: tuple[int, int], border: int = 0) -> bytes:
+    generator = numpy.random.default_rng(seed)
+    noise = generator.integers(0, 256, (12, 9, 3), dtype=numpy.uint8)
+    image = Image.fromarray(noise).resize(size, Image.BICUBIC)
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y = generator.integers(0, size[0]), generator.integers(0, size[1])
+        radius = generator.integers(size[0] // 10, size[0] // 3)
+        fill = tuple(int(value) for value in generator.integers(0, 256, 3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=fill)
+    if border:
+        image = ImageOps.expand(image, border=border, fill=(255, 255, 255))
+
+    with io.BytesIO() as buffer:
+        image.save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue()
+
+
+def hash_distance(a: str, b: str) -> int:
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def full_decode(data: bytes, size: tuple[int, int] = None) -> Image:
+    return Image.open(io.BytesIO(data))
+
+
+# Covers are drafted when thumbnails are created, which must not move their hashes out of their group.
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("size", [(600, 850), (1200, 1700), (2400, 3400)])
+def test_draft_thumbnail_hashes_match_full_decode(seed: int, size: tuple[int, int]):
+    data = cover_jpeg(seed, size)
+    drafted = load_image(data, THUMBNAIL_SIZE)
+    full = load_image(data)
+    if size[0] >= THUMBNAIL_SIZE[0] * 4:
+        assert drafted.size != full.size
+
+    for hash_size, max_distance in [(8, MAX_H8_DISTANCE), (16, MAX_H16_DISTANCE)]:
+        drafted_hash, full_hash = image_hashes([drafted, full], size=hash_size)
+        assert hash_distance(drafted_hash, full_hash) <= max_distance
+
+
+# Stored thumbnails are hashed as they were decoded in full, including the trimmed,
+# cropped and rotated candidates, so that hashes of stored thumbnails never change.
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("size, border", [
+    ((600, 850), 0), ((850, 600), 0), ((600, 850), 40), ((850, 600), 40), ((800, 800), 0), ((800, 800), 40),
+])
+def test_thumbnail_candidates_match_full_decode(monkeypatch, seed: int, size: tuple[int, int], border: int):
+    thumbnail = create_thumbnail(cover_jpeg(seed, size, border))
+    candidates = candidate_images([thumbnail])
+    monkeypatch.setattr(image_hashing, "load_image", full_decode)
+    expected = candidate_images([thumbnail])
+
+    assert candidates[0].size == Image.open(io.BytesIO(thumbnail)).size
+    assert [image.size for image in candidates] == [image.size for image in expected]
+    for hash_size in [8, 16]:
+        assert image_hashes(candidates, size=hash_size) == image_hashes(expected, size=hash_size)
@@ -0,0 +1,69 @@
+import asyncio
+
+from scripts import source_md
+from scripts.source_md import MDManga, MDScraper, MDStatistics
+
+
+class StatisticsResponse:
+    def __init__(self, statistics: dict):
+        self.statistics = statistics
+
+    def json(self) -> dict:
+        return {"result": "ok", "statistics": self.statistics}
+
+
+# Answers for every title and chapter except those in `missing`.
+class StatisticsClient:
+    def __init__(self, missing: set[str]):
+        self.missing = missing
+
+    def get(self, url: str, params: dict = None) -> StatisticsResponse:
+        uuids = params.get("manga[]") or params.get("chapter[]")
+        return StatisticsResponse({
+            uuid: {"comments": {"threadId": 1, "repliesCount": 3}}
+            for uuid in uuids if uuid not in self.missing
+        })
+
+
+def create_manga(slug: str, chapter_ids: list[str]):
+    MDManga.create(
+        slug=slug,
+        data={"attributes": {}},
+        covers=[],
+        chapters=[{
+            "id": chapter_id,
+            "type": "chapter",
+            "attributes": {"chapter": "1", "title": None, "translatedLanguage": "en",
+                           "publishAt": "2020-01-01T00:00:00+00:00", "pages": 20},
+        } for chapter_id in chapter_ids],
+        thumbnail=b"",
+    )
+
+
+async def scrape_statistics(scraper: MDScraper):
+    with scraper.executor:
+        async with scraper.writer():
+            await source_md.scrape_statistics_async(scraper)
+
+
+# A title left out of the response still gets statistics, so that the build can read it.
+def test_missing_statistics_are_written(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    monkeypatch.setattr(source_md, "client", StatisticsClient({"new-manga", "new-chapter"}))
+    source_md.db.create_tables([MDManga, MDStatistics])
+    try:
+        create_manga("old-manga", ["old-chapter"])
+        create_manga("new-manga", ["new-chapter"])
+        asyncio.run(scrape_statistics(MDScraper()))
+
+        old = MDManga.get_by_id("old-manga")
+        new = MDManga.get_by_id("new-manga")
+        assert source_md.md_manga_comments(old) == 3
+        assert source_md.md_manga_comments(new) == 0
+        assert MDStatistics.get(manga=new).title["follows"] == 0
+
+        comments = {entry.slug: entry.comments for entry in source_md.all_md_chapters(thumbnails=False)}
+        assert comments == {"old-chapter": 3, "new-chapter": None}
+    finally:
+        source_md.db.close()